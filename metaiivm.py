@@ -1,43 +1,801 @@
 #!/usr/bin/env python3
 import re
 import sys
-from collections import namedtuple
-import argparse
-
-
-LINE_RE = re.compile(r"^\s+([A-Za-z]\w*)\s*([A-Za-z]\w+|'[^']*')?$")
+import os
+import io
+import time
+import codecs
+import marshal
+import struct
+from array import array
+from collections import OrderedDict, namedtuple
+from itertools import repeat
+# argparse, concurrent.futures, glob, hashlib, json and tempfile are
+# imported where they are used, off the startup path of a plain run
+
+
+__version__ = "0.2.0"
+
+SPACE_RE = re.compile(r"\s+")
+
+# Regular expressions compiled by regex() when first needed. Token patterns
+# (named after their ops) are matched in place with .match(buf, pos), so no
+# anchors. The _PARTIAL ones match the beginnings of tokens cut off by the
+# end of a streamed input window, which may still match once more input is
+# read.
+REGEXES = {
+    "LINE": r"^\s+([A-Za-z]\w*)\s*([A-Za-z]\w+|'[^']*')?$",
+    "ID": r"[A-Za-z]\w+",
+    "NUM": r"\d+",
+    "SR": r"'[^']*'",
+    "ID_PARTIAL": r"[A-Za-z]\w*\Z",
+    "SR_PARTIAL": r"'[^']*\Z",
+}
+_regexes = {}
+# token pattern -> name of its _PARTIAL regex
+PARTIAL = {REGEXES["ID"]: "ID_PARTIAL", REGEXES["SR"]: "SR_PARTIAL"}
+
+
+def regex(name):
+    """The compiled regular expression REGEXES[name]."""
+    pattern = _regexes.get(name)
+    if pattern is None:
+        pattern = _regexes[name] = re.compile(REGEXES[name])
+    return pattern
 
 
 Inst = namedtuple("Inst", ["op", "arg", "labels"])
 
+# Opcodes of the linked form, in the order of their small integer codes
+OPS = ("TST", "ID", "NUM", "SR", "CLL", "R", "SET", "B", "BT", "BF", "BE",
+       "CL", "CI", "GN1", "GN2", "LB", "OUT", "ADR", "END")
+OPCODES = {op: code for code, op in enumerate(OPS)}
+
+OP_CLL = OPCODES["CLL"]
+# ops scanning the token REGEXES of the same name
+TOKEN_OPCODES = frozenset(OPCODES[op] for op in ("ID", "NUM", "SR"))
+OP_R = OPCODES["R"]
+# ops adding to the output buffer
+OP_OUTPUT = tuple(OPCODES[op] for op in ("CL", "CI", "GN1", "GN2"))
+
+# How much of the input and the call stack --trace shows
+TRACE_INPUT = 40
+TRACE_CALLS = 8
+
+# Ops taking a label argument, resolved to a pc by the linker
+LABEL_OPS = frozenset(("CLL", "B", "BT", "BF", "ADR"))
+LABEL_OPCODES = frozenset(OPCODES[op] for op in LABEL_OPS)
+
+ASCII = frozenset(map(chr, range(128)))
+
+# Binary bytecode (.mbc) files, all integers little-endian:
+#
+#   header   "MIIB", then u32 version, instruction, string and label counts
+#   strings  u32 end offset of each string, in characters, then u32 byte
+#            length and the UTF-8 text of all strings concatenated
+#   ops      one opcode byte per instruction (see OPS)
+#   args     u32 per instruction: a pc for label ops, otherwise 0 for no
+#            argument or 1 + the index of the string argument
+#   labels   u32 string index of the label name and u32 pc, per label
+MBC_MAGIC = b"MIIB"
+MBC_VERSION = 1
+MBC_HEADER = struct.Struct("<4sIIII")
+
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "pymetaii")
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+# Smaller code is parsed faster than the cache can hash and load it
+CACHE_MIN_BYTES = 32 * 1024
+
+
+def main(argv=None):
+    import argparse
+
+    argv = sys.argv[1:] if argv is None else argv
+    commands = {"assemble": main_assemble, "optimize": main_optimize,
+                "pipeline": main_pipeline, "serve": main_serve,
+                "client": main_client}
+    if argv[:1] and argv[0] in commands:
+        return commands[argv[0]](argv[1:])
 
-def main():
     descr = "META II metacompiler."
-    parser = argparse.ArgumentParser(description=descr)
+    parser = argparse.ArgumentParser(
+        description=descr, formatter_class=help_formatter,
+        epilog="Use '%(prog)s assemble' to turn code into bytecode, "
+        "'%(prog)s optimize' to optimize code, '%(prog)s pipeline' to chain "
+        "grammars, '%(prog)s serve' to run a compile server and "
+        "'%(prog)s client' to send it input.")
+    parser.add_argument("code", type=argparse.FileType("rb"),
+                        help="path to META II parsing machine code, as text "
+                        "or bytecode")
+    parser.add_argument("-i", "--input", action="append", default=[],
+                        help="file with input to be parsed (stdin by default); "
+                        "repeat it or use a glob pattern for a batch")
+    parser.add_argument("--manifest", type=argparse.FileType("r"),
+                        help="batch: file listing input paths, one per line")
+    parser.add_argument("--out-dir",
+                        help="batch: directory for outputs (default: next to "
+                        "each input)")
+    parser.add_argument("--out-ext", default=".out",
+                        help="batch: output file extension replacing the "
+                        "input's one (default: %(default)s)")
+    parser.add_argument("--flush", type=flush_policy, default="64K",
+                        help="write output every line, at the end, or every "
+                        "SIZE characters like 64K (default: %(default)s)")
+    parser.add_argument("--output-encoding",
+                        help="write output as bytes in this encoding")
+    parser.add_argument("--count", action="store_true",
+                        help="print the number of output lines and "
+                        "characters instead of the output")
+    parser.add_argument("--stream", action="store_true",
+                        help="read the input in chunks instead of all at "
+                        "once, keeping memory bounded for large inputs")
+    parser.add_argument("--max-depth", type=int,
+                        help="fail when rule calls nest deeper than this")
+    parser.add_argument("--max-output", type=parse_size, metavar="SIZE",
+                        help="fail when an output line grows over SIZE "
+                        "characters")
+    parser.add_argument("--checkpoint", metavar="FILE",
+                        help="save the state of the run to FILE every "
+                        "--checkpoint-every instructions, and resume from it "
+                        "if it exists")
+    parser.add_argument("--checkpoint-every", type=int,
+                        default=CHECKPOINT_EVERY, metavar="N",
+                        help="instructions between checkpoints (default: "
+                        "%(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="batch: number of worker processes")
+    parser.add_argument("--trace", action="store_true")
+    parser.add_argument("--memo", type=int, nargs="?", const=1 << 16,
+                        metavar="ENTRIES",
+                        help="memoize rule calls, keeping at most ENTRIES "
+                        "results (default: %(const)s)")
+    parser.add_argument("--profile", action="store_true",
+                        help="print per-rule and per-op statistics to stderr")
+    parser.add_argument("--profile-json", type=argparse.FileType("w"),
+                        help="write the --profile statistics as JSON here")
+    parser.add_argument("--engine", choices=ENGINES, default="interp",
+                        help="run the code instruction by instruction or "
+                        "compiled to Python functions (no --trace, --profile, "
+                        "--memo, limits or --checkpoint)")
+    parser.add_argument("--optimize", action="store_true",
+                        help="run the code through the peephole optimizer "
+                        "first")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not use the linked code cache in "
+                        "{}".format(CACHE_DIR))
+    args = parser.parse_args(argv)
+    if args.engine == "compiled" and (
+            args.trace or args.profile or args.profile_json or
+            args.memo is not None or args.max_depth is not None or
+            args.max_output is not None or args.checkpoint):
+        parser.error("--engine compiled can't be used with --trace, "
+                     "--profile, --memo, --max-depth, --max-output or "
+                     "--checkpoint")
+    if args.checkpoint:
+        if args.checkpoint_every < 1:
+            parser.error("--checkpoint-every must be at least 1")
+        if args.memo or args.trace or args.profile or args.profile_json:
+            parser.error("--checkpoint can't be used with --memo, --trace "
+                         "or --profile")
+
+    source = args.code.read()
+    cache = (None if args.no_cache or len(source) < CACHE_MIN_BYTES
+             else ProgramCache())
+    try:
+        program = load_program(source, cache, optimized=args.optimize)
+    except ValueError as e:
+        print("{}: {}".format(args.code.name, e), file=sys.stderr)
+        return 1
+
+    try:
+        paths = input_paths(args.input, args.manifest)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    if args.checkpoint and (len(paths) != 1 or args.manifest or
+                            args.out_dir):
+        parser.error("--checkpoint needs a single input file (-i)")
+    if len(paths) > 1 or args.manifest or args.out_dir:
+        if (args.trace or args.profile or args.profile_json or
+                args.memo is not None or args.count or args.stream or
+                args.output_encoding):
+            parser.error("batch runs can't be used with --trace, --profile, "
+                         "--memo, --count, --stream or --output-encoding")
+        return run_batch(program, paths, args)
+
+    try:
+        input_file = open(paths[0]) if paths else sys.stdin
+    except OSError as e:
+        print("{}: {}".format(paths[0], e.strerror), file=sys.stderr)
+        return 1
+    output_file = sys.stdout.buffer if args.output_encoding else sys.stdout
+    if args.count:
+        output_file = LineCounter()
+    vm = VM(input_file if args.stream else input_file.read(), output_file,
+            flush=args.flush, encoding=args.output_encoding,
+            max_depth=args.max_depth, max_output=args.max_output)
+    profile = Profiler() if args.profile or args.profile_json else None
+    memo = MemoTable(args.memo) if args.memo else None
+    checkpoint = (Checkpoint(args.checkpoint, args.checkpoint_every,
+                             input_id(paths[0]))
+                  if args.checkpoint else None)
+    if checkpoint is not None:
+        try:
+            saved = checkpoint.load()
+            if saved is not None:
+                vm.restore(saved[0], program)
+        except ValueError as e:
+            print("{}: {}".format(args.checkpoint, e), file=sys.stderr)
+            return 1
+        if saved is not None and saved[1] is not None:
+            # drop what was written after the checkpoint, when the output
+            # is the file written then (the shell may have truncated it)
+            try:
+                if output_file.seek(0, io.SEEK_END) >= saved[1]:
+                    output_file.seek(saved[1])
+                    output_file.truncate()
+            except (AttributeError, OSError, ValueError):
+                pass
+    try:
+        vm.run(program, trace=args.trace, engine=args.engine,
+               profile=profile, memo=memo, checkpoint=checkpoint)
+    except LimitError as e:
+        if checkpoint is not None:
+            checkpoint.remove()
+        print("Failed to parse input: {}".format(e), file=sys.stderr)
+        return 1
+    if checkpoint is not None:
+        checkpoint.remove()
+
+    if args.count:
+        print("{} lines, {} characters".format(output_file.lines,
+                                               output_file.chars))
+    if args.profile:
+        print(profile.table(), end="", file=sys.stderr)
+        if memo:
+            print("\nmemo: {}".format(memo.stats()), file=sys.stderr)
+    if args.profile_json:
+        import json
+        json.dump(profile.as_dict(), args.profile_json, indent=2)
+
+
+def main_assemble(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + " assemble",
+        formatter_class=help_formatter,
+        description="Assemble META II code into bytecode, which loads "
+        "without parsing.")
     parser.add_argument("code", type=argparse.FileType("r"),
-                        help="path to a META II parsing machine code ")
+                        help="path to META II parsing machine code")
+    parser.add_argument("-o", "--output", required=True,
+                        help="bytecode file to write, conventionally .mbc")
+    args = parser.parse_args(argv)
+
+    try:
+        data = assemble(parse_code(args.code))
+    except ValueError as e:
+        print("{}: {}".format(args.code.name, e), file=sys.stderr)
+        return 1
+    with open(args.output, "wb") as output_file:
+        output_file.write(data)
+    return 0
+
+
+def main_optimize(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + " optimize",
+        formatter_class=help_formatter,
+        description="Run META II code through the peephole optimizer and "
+        "report what changed on stderr.")
+    parser.add_argument("code", type=argparse.FileType("r"),
+                        help="path to META II parsing machine code")
+    parser.add_argument("-o", "--output", type=argparse.FileType("w"),
+                        default=sys.stdout,
+                        help="file to write the optimized code to (stdout by "
+                        "default)")
+    args = parser.parse_args(argv)
+
+    try:
+        code = parse_code(args.code)
+        optimized, report = optimize(code)
+    except ValueError as e:
+        print("{}: {}".format(args.code.name, e), file=sys.stderr)
+        return 1
+    args.output.write(format_code(optimized))
+
+    print("{}: {} -> {} instructions".format(
+        args.code.name, len(code), len(optimized)), file=sys.stderr)
+    for change, count in report.items():
+        if count:
+            print("  {}: {}".format(change, count), file=sys.stderr)
+    return 0
+
+
+def main_pipeline(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + " pipeline",
+        usage="%(prog)s [options] code source... [-- input]",
+        formatter_class=help_formatter,
+        description="Compile each source with the code generated from the "
+        "one before, starting with code, then run the last code generated "
+        "over input (stdin by default).")
+    parser.add_argument("code", type=argparse.FileType("rb"),
+                        help="META II code, as text or bytecode")
+    parser.add_argument("source", nargs="+",
+                        help="grammar compiled with the code so far")
+    parser.add_argument("--flush", type=flush_policy, default="64K",
+                        help="write output every line, at the end, or every "
+                        "SIZE characters like 64K (default: %(default)s)")
+    parser.add_argument("--engine", choices=ENGINES, default="interp")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="do not use the code cache in {}".format(
+                            CACHE_DIR))
+    inputs = []
+    if "--" in argv:
+        inputs = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+    args = parser.parse_args(argv)
+    if len(inputs) > 1:
+        parser.error("expected at most one input after --")
+
+    sources = []
+    for path in args.source:
+        try:
+            with open(path) as source_file:
+                sources.append(source_file.read())
+        except OSError as e:
+            print("{}: {}".format(path, e.strerror), file=sys.stderr)
+            return 1
+    cache = None if args.no_cache else ProgramCache()
+    try:
+        program = load_pipeline(args.code.read(), sources, cache)
+    except ValueError as e:
+        print("Failed to compile {}: {}".format(args.code.name, e),
+              file=sys.stderr)
+        return 1
+
+    try:
+        input_file = open(inputs[0]) if inputs else sys.stdin
+    except OSError as e:
+        print("{}: {}".format(inputs[0], e.strerror), file=sys.stderr)
+        return 1
+    vm = VM(input_file.read(), sys.stdout, flush=args.flush)
+    vm.run(program, engine=args.engine)
+    return 1 if vm.is_err else 0
+
+
+def main_serve(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + " serve",
+        formatter_class=help_formatter,
+        description="Serve compile requests for preloaded code on a Unix "
+        "domain socket, see '{} client'.".format(
+            os.path.basename(sys.argv[0])))
+    parser.add_argument("socket", help="path of the socket to listen on")
+    parser.add_argument("code", nargs="+",
+                        help="code (text or bytecode) to preload, known to "
+                        "clients by its file name without extension, or "
+                        "given as ID=PATH")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="number of worker processes (default: all "
+                        "cores)")
+    parser.add_argument("--engine", choices=ENGINES, default="interp")
+    parser.add_argument("--max-depth", type=int,
+                        help="fail when rule calls nest deeper than this")
+    parser.add_argument("--max-output", type=parse_size, metavar="SIZE",
+                        help="fail when an output line grows over SIZE "
+                        "characters")
+    args = parser.parse_args(argv)
+    if args.engine == "compiled" and (args.max_depth is not None or
+                                      args.max_output is not None):
+        parser.error("--engine compiled can't be used with --max-depth or "
+                     "--max-output")
+
+    programs = {}
+    for grammar, path in grammar_paths(args.code).items():
+        try:
+            with open(path, "rb") as code_file:
+                programs[grammar] = load_program(code_file.read())
+        except OSError as e:
+            print("{}: {}".format(path, e.strerror), file=sys.stderr)
+            return 1
+        except ValueError as e:
+            print("{}: {}".format(path, e), file=sys.stderr)
+            return 1
+    print("serving {} on {}".format(", ".join(sorted(programs)),
+                                     args.socket), file=sys.stderr)
+    serve(args.socket, programs, jobs=args.jobs, engine=args.engine,
+          max_depth=args.max_depth, max_output=args.max_output)
+    return 0
+
+
+def main_client(argv):
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(sys.argv[0]) + " client",
+        formatter_class=help_formatter,
+        description="Compile input with code preloaded by a server started "
+        "with '{} serve'.".format(os.path.basename(sys.argv[0])))
+    parser.add_argument("socket", help="path of the server's socket")
+    parser.add_argument("grammar", help="id of the code to run")
     parser.add_argument("-i", "--input", type=argparse.FileType("r"),
                         default=sys.stdin,
-                        help="file with input to be parsed (stdin by default)")
-    parser.add_argument("--trace", action="store_true")
-    args = parser.parse_args()
+                        help="file with input to be parsed (stdin by "
+                        "default)")
+    args = parser.parse_args(argv)
+
+    with Client(args.socket) as client:
+        result = client.compile(args.grammar, args.input.read())
+    if not result.ok:
+        print(result.error, file=sys.stderr)
+        return 1
+    sys.stdout.write(result.output)
+    return 0
+
+
+def help_formatter(prog):
+    """An argparse help formatter as wide as the terminal. argparse makes
+    one for every option added and sizes it with shutil, which is slow to
+    import; os can tell the terminal size too.
+    """
+    import argparse
+
+    try:
+        columns = os.get_terminal_size(sys.__stdout__.fileno()).columns
+    except (AttributeError, ValueError, OSError):
+        columns = 80
+    return argparse.HelpFormatter(
+        prog, width=int(os.environ.get("COLUMNS", columns)) - 2)
+
+
+def input_paths(inputs, manifest=None):
+    """Input paths from -i options, expanding glob patterns, followed by the
+    ones listed in the manifest file. Raises ValueError, with a line for
+    each, if patterns match no files.
+    """
+    paths = []
+    unmatched = []
+    for path in inputs:
+        if any(char in path for char in "*?["):
+            import glob
+            matches = sorted(glob.glob(path))
+            if not matches:
+                unmatched.append(path)
+            paths.extend(matches)
+        else:
+            paths.append(path)
+    if unmatched:
+        raise ValueError("\n".join("{}: no files match".format(path)
+                                   for path in unmatched))
+    if manifest:
+        paths.extend(line.strip() for line in manifest if line.strip())
+    return paths
+
+
+def input_id(path):
+    """Size and CRC-32 of the file at path, telling inputs apart in
+    checkpoints.
+    """
+    import zlib
+
+    crc = 0
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+    return size, crc
+
+
+def output_path(path, out_dir, out_ext):
+    base = os.path.splitext(os.path.basename(path))[0] + out_ext
+    return os.path.join(out_dir or os.path.dirname(path), base)
+
+
+def run_batch(program, paths, args):
+    """Compile every path with one loaded program, writing outputs next to
+    the inputs or into args.out_dir. Reports each file on stderr and returns
+    the exit status.
+    """
+    outputs = {}
+    for path in paths:
+        out_path = output_path(path, args.out_dir, args.out_ext)
+        if out_path in outputs:
+            print("{}: output {} also written for {}".format(
+                path, out_path, outputs[out_path]), file=sys.stderr)
+            return 1
+        outputs[out_path] = path
+    if args.out_dir:
+        os.makedirs(args.out_dir, exist_ok=True)
+
+    limits = {"max_depth": args.max_depth, "max_output": args.max_output}
+    if args.jobs > 1:
+        results = compile_parallel(program, paths, jobs=args.jobs,
+                                   engine=args.engine, **limits)
+    else:
+        results = compile_files(program, paths, engine=args.engine, **limits)
+
+    failed = 0
+    for path, result in zip(paths, results):
+        if result.ok:
+            with open(output_path(path, args.out_dir, args.out_ext),
+                      "w") as output_file:
+                output_file.write(result.output)
+            print("{}: ok in {:.2f} ms".format(path, result.seconds * 1e3),
+                  file=sys.stderr)
+        else:
+            failed += 1
+            print("{}: {}".format(path, result.error), file=sys.stderr)
+
+    return 1 if failed else 0
+
+
+def compile_files(code, paths, engine="interp", max_depth=None,
+                  max_output=None):
+    """Run code over the contents of each file in paths, yielding a RunResult
+    per path. Unreadable or undecodable files and exceeded limits (see VM) are reported in
+    their result.
+    """
+    program = link(code)
+    vm = VM("", max_depth=max_depth, max_output=max_output)
+    for path in paths:
+        yield compile_file(vm, program, path, engine)
+
+
+def compile_file(vm, program, path, engine="interp"):
+    try:
+        with open(path) as input_file:
+            input_buf = input_file.read()
+    except OSError as e:
+        return RunResult(None, False, 0.0, e.strerror)
+    except UnicodeDecodeError as e:
+        return RunResult(None, False, 0.0, str(e))
+    return next(vm.run_many(program, [input_buf], engine=engine))
+
+
+def compile_parallel(code, paths, jobs=None, engine="interp", chunksize=8,
+                     max_depth=None, max_output=None):
+    """Same as compile_files, but over a pool of jobs worker processes (all
+    cores by default). Each worker receives the linked program once, then
+    reads the files it is handed by path, chunksize paths at a time. Results
+    are yielded in the order of paths.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    program = link(code)
+    with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_worker_init,
+            initargs=(program.ops, program.args, program.label_to_pc,
+                      engine, max_depth, max_output)) as executor:
+        yield from executor.map(_worker_compile, paths, chunksize=chunksize)
+
+
+# Per-process state of compile_parallel workers
+_worker = None
+
+
+def _worker_init(ops, args, label_to_pc, engine, max_depth, max_output):
+    global _worker
+    _worker = (VM("", max_depth=max_depth, max_output=max_output),
+               Program(ops, args, label_to_pc), engine)
+
+
+def _worker_compile(path):
+    vm, program, engine = _worker
+    return compile_file(vm, program, path, engine)
+
+
+# Compile server frames are a u32 big-endian length followed by that many
+# bytes of UTF-8 JSON. A request is {"grammar": ID, "input": TEXT} and the
+# response the fields of a RunResult. A connection may carry any number of
+# requests, answered in order.
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME = 1 << 30
+
+
+def encode_frame(obj):
+    import json
+
+    data = json.dumps(obj).encode()
+    return FRAME_HEADER.pack(len(data)) + data
+
+
+def decode_frame(data):
+    import json
+
+    return json.loads(data.decode())
+
+
+def grammar_paths(codes):
+    """Map grammar ids to code paths. A path's id is its file name without
+    extension, unless given as ID=PATH.
+    """
+    grammars = {}
+    for code in codes:
+        grammar, sep, path = code.partition("=")
+        if not sep:
+            path = code
+            grammar = os.path.splitext(os.path.basename(code))[0]
+        grammars[grammar] = path
+    return grammars
+
+
+def serve(path, programs, jobs=None, engine="interp", max_depth=None,
+          max_output=None):
+    """Answer compile requests on the Unix domain socket at path until
+    SIGINT or SIGTERM. programs maps grammar ids to code. An asyncio loop
+    takes the connections and hands requests to a pool of jobs worker
+    processes (all cores by default), each holding the linked programs and
+    one VM reset for every request.
+    """
+    import asyncio
+    from concurrent.futures import ProcessPoolExecutor
+
+    programs = {grammar: link(code) for grammar, code in programs.items()}
+    with ProcessPoolExecutor(
+            max_workers=jobs, initializer=_serve_init,
+            initargs=({grammar: (program.ops, program.args,
+                                 program.label_to_pc)
+                       for grammar, program in programs.items()},
+                      engine, max_depth, max_output)) as executor:
+        try:
+            asyncio.run(_serve(path, set(programs), executor))
+        finally:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+async def _serve(path, grammars, executor):
+    import asyncio
+    import signal
+
+    loop = asyncio.get_running_loop()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    break
+                size, = FRAME_HEADER.unpack(header)
+                if size > MAX_FRAME:
+                    result = RunResult(None, False, 0.0, "Frame too large")
+                    writer.write(encode_frame(result._asdict()))
+                    break
+
+                try:
+                    request = decode_frame(await reader.readexactly(size))
+                    grammar = request["grammar"]
+                    input_buf = request["input"]
+                    if not isinstance(grammar, str):
+                        raise TypeError("grammar is not a string")
+                    if not isinstance(input_buf, str):
+                        raise TypeError("input is not a string")
+                except (ValueError, KeyError, TypeError) as e:
+                    result = RunResult(None, False, 0.0,
+                                       "Bad request: {}".format(e))
+                else:
+                    if grammar in grammars:
+                        try:
+                            result = await loop.run_in_executor(
+                                executor, _serve_compile, grammar, input_buf)
+                        except Exception as e:
+                            # a failing worker fails the request, not the
+                            # connection
+                            result = RunResult(None, False, 0.0,
+                                               "Compile failed: {!r}".format(
+                                                   e))
+                    else:
+                        result = RunResult(None, False, 0.0,
+                                           "Unknown grammar: {}".format(
+                                               grammar))
+                writer.write(encode_frame(result._asdict()))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    stop = loop.create_future()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set_result, None)
+
+    server = await asyncio.start_unix_server(handle, path)
+    async with server:
+        await stop
+
+
+# Per-process state of serve workers
+_serve_worker = None
+
+
+def _serve_init(programs, engine, max_depth, max_output):
+    global _serve_worker
+    _serve_worker = (VM("", max_depth=max_depth, max_output=max_output),
+                     {grammar: Program(*fields)
+                      for grammar, fields in programs.items()},
+                     engine)
+
+
+def _serve_compile(grammar, input_buf):
+    vm, programs, engine = _serve_worker
+    return next(vm.run_many(programs[grammar], [input_buf], engine=engine))
+
+
+class Client:
+    """Blocking connection to a compile server (see serve)."""
+
+    def __init__(self, path):
+        import socket
+
+        self.sock = socket.socket(socket.AF_UNIX)
+        try:
+            self.sock.connect(path)
+        except OSError:
+            self.sock.close()
+            raise
+
+    def compile(self, grammar, input_buf):
+        """Run the code known to the server as grammar over input_buf,
+        returning a RunResult.
+        """
+        self.sock.sendall(encode_frame({"grammar": grammar,
+                                        "input": input_buf}))
+        size, = FRAME_HEADER.unpack(self.recv(FRAME_HEADER.size))
+        return RunResult(**decode_frame(self.recv(size)))
 
-    vm = VM(args.input.read())
-    code = parse_code(args.code)
-    vm.run(code, trace=args.trace)
+    def recv(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(min(size, 1 << 20))
+            if not chunk:
+                raise ConnectionError("Server closed the connection")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 
 def parse_code(file_object):
+    """Parse META II code lines into a list of Inst. Raises ValueError for
+    an instruction line that does not parse.
+    """
+    line_re = regex("LINE")
     instructions = []
     labels = []
-    for line in file_object:
+    for line_number, line in enumerate(file_object, 1):
         # skip empty lines
         if not line.strip():
             continue
 
         # lines starting with spaces
         if line[0].isspace():
-            match = LINE_RE.match(line)
+            match = line_re.match(line)
+            if not match:
+                raise ValueError("line {}: not an instruction: {!r}".format(
+                    line_number, line.strip()))
 
             # Op itself
             op = match[1]
@@ -57,25 +815,1243 @@ def parse_code(file_object):
     return instructions
 
 
+class Program:
+    """Linked META II code: parallel opcodes (a byte array) and arguments,
+    with label arguments already resolved to absolute pcs and string
+    arguments interned.
+    """
+
+    def __init__(self, ops, args, label_to_pc):
+        self.ops = array("B", ops)
+        self.args = args
+        self.label_to_pc = label_to_pc
+
+        # filled in by compile_program and dispatch_index
+        self.compiled = None
+        self.dispatch = None
+        self.crc = None
+
+    def __len__(self):
+        return len(self.ops)
+
+    def checksum(self):
+        """CRC-32 of the opcodes and arguments, telling programs apart in
+        VM snapshots.
+        """
+        if self.crc is None:
+            import zlib
+
+            self.crc = zlib.crc32(marshal.dumps((self.ops.tobytes(),
+                                                 self.args)))
+        return self.crc
+
+    def inst(self, pc):
+        """Readable form of an instruction, for tracing. Label arguments
+        are shown by name.
+        """
+        op = OPS[self.ops[pc]]
+        arg = self.args[pc]
+        if op in LABEL_OPS:
+            arg = " " + rule_name(self.label_to_pc, arg)
+        else:
+            arg = "" if arg is None else " " + repr(arg)
+        return "{:>5} {:<4}{}".format(pc, op, arg)
+
+    def insts(self):
+        """The program as a list of Inst again, the inverse of link."""
+        labels = [[] for _ in self.ops]
+        pc_to_label = {}
+        for label, pc in self.label_to_pc.items():
+            labels[pc].append(label)
+            pc_to_label.setdefault(pc, label)
+
+        return [Inst(op=OPS[op],
+                     arg=pc_to_label[arg] if OPS[op] in LABEL_OPS else arg,
+                     labels=labels[pc])
+                for pc, (op, arg) in enumerate(zip(self.ops, self.args))]
+
+
+def link(code):
+    """Turn a list of Inst (see parse_code) into a Program. Bytecode (see
+    assemble) is loaded instead.
+    """
+    if isinstance(code, Program):
+        return code
+    if isinstance(code, (bytes, bytearray, memoryview)):
+        return load_bytecode(code)
+
+    label_to_pc = {}
+    for i, instr in enumerate(code):
+        for label in instr.labels:
+            label_to_pc[label] = i
+
+    ops = array("B")
+    args = []
+    for instr in code:
+        if instr.op not in OPCODES:
+            raise ValueError("Unknown op: {}".format(instr.op))
+        ops.append(OPCODES[instr.op])
+
+        arg = instr.arg
+        if instr.op in LABEL_OPS:
+            if arg not in label_to_pc:
+                raise ValueError("Undefined label: {}".format(arg))
+            arg = label_to_pc[arg]
+        elif arg is not None:
+            arg = sys.intern(arg)
+        args.append(arg)
+
+    return Program(ops, args, label_to_pc)
+
+
+def assemble(code):
+    """Link code and encode it as .mbc bytecode (see MBC_MAGIC)."""
+    program = link(code)
+
+    strings = []
+    string_index = {}
+
+    def intern(text):
+        if text not in string_index:
+            string_index[text] = len(strings)
+            strings.append(text)
+        return string_index[text]
+
+    args = []
+    for op, arg in zip(program.ops, program.args):
+        if OPS[op] in LABEL_OPS:
+            args.append(arg)
+        else:
+            args.append(0 if arg is None else 1 + intern(arg))
+    labels = []
+    for label, pc in program.label_to_pc.items():
+        labels.extend((intern(label), pc))
+
+    ends = []
+    end = 0
+    for text in strings:
+        end += len(text)
+        ends.append(end)
+    text = "".join(strings).encode()
+
+    return b"".join([
+        MBC_HEADER.pack(MBC_MAGIC, MBC_VERSION, len(program), len(strings),
+                        len(program.label_to_pc)),
+        struct.pack("<{}I".format(len(ends)), *ends),
+        struct.pack("<I", len(text)), text,
+        program.ops.tobytes(),
+        struct.pack("<{}I".format(len(args)), *args),
+        struct.pack("<{}I".format(len(labels)), *labels),
+    ])
+
+
+def load_bytecode(data):
+    """Decode .mbc bytecode (see assemble) into a Program. Raises ValueError
+    on anything that is not bytecode of this version.
+    """
+    data = memoryview(data)
+    try:
+        magic, version, n_ops, n_strings, n_labels = \
+            MBC_HEADER.unpack_from(data)
+        if magic != MBC_MAGIC or version != MBC_VERSION:
+            raise ValueError("Not META II bytecode version {}".format(
+                MBC_VERSION))
+        offset = MBC_HEADER.size
+
+        ends = struct.unpack_from("<{}I".format(n_strings), data, offset)
+        offset += 4 * n_strings
+        text_len, = struct.unpack_from("<I", data, offset)
+        offset += 4
+        text = str(data[offset:offset + text_len], "utf-8")
+        offset += text_len
+        # argument 0 is no argument, n the string at index n - 1
+        strings = [None]
+        start = 0
+        for end in ends:
+            strings.append(sys.intern(text[start:end]))
+            start = end
+
+        ops = bytes(data[offset:offset + n_ops])
+        offset += n_ops
+        args = struct.unpack_from("<{}I".format(n_ops), data, offset)
+        offset += 4 * n_ops
+        labels = struct.unpack_from("<{}I".format(2 * n_labels), data,
+                                    offset)
+        offset += 8 * n_labels
+    except (struct.error, UnicodeDecodeError) as e:
+        raise ValueError("Corrupt META II bytecode: {}".format(e))
+    if offset != len(data):
+        raise ValueError("Corrupt META II bytecode: trailing data")
+
+    if ops and max(ops) >= len(OPS):
+        raise ValueError("Unknown opcode: {}".format(max(ops)))
+    for op, arg in zip(ops, args):
+        if arg >= (n_ops if op in LABEL_OPCODES else len(strings)):
+            raise ValueError("Corrupt META II bytecode: {} argument {} out "
+                             "of range".format(OPS[op], arg))
+    for i in range(0, len(labels), 2):
+        if labels[i] >= n_strings or labels[i + 1] >= n_ops:
+            raise ValueError("Corrupt META II bytecode: label {} out of "
+                             "range".format(i // 2))
+    args = [arg if op in LABEL_OPCODES else strings[arg]
+            for op, arg in zip(ops, args)]
+    label_to_pc = {strings[labels[i] + 1]: labels[i + 1]
+                   for i in range(0, len(labels), 2)}
+
+    return Program(ops, args, label_to_pc)
+
+
+# Ops falling through without reading or setting the switch, and ops
+# setting it without reading it
+SWITCH_TRANSPARENT_OPS = frozenset(("CL", "CI", "GN1", "GN2", "LB", "OUT"))
+SWITCH_SET_OPS = frozenset(("TST", "ID", "NUM", "SR", "SET"))
+
+OPTIMIZATIONS = ("branches threaded", "branches resolved", "branches removed",
+                 "BE removed", "SET removed", "unreachable removed",
+                 "labels removed")
+
+
+def optimize(code):
+    """Peephole optimizer: returns an equivalent list of Inst for code (see
+    link) and a report, {change: count} for each of OPTIMIZATIONS.
+
+    Until nothing changes, branches to B, to a BT or BF on the same switch
+    or to R are threaded, BT, BF and BE are resolved where the switch is
+    known (after SET, an untaken BT or BF, or BE), branches to the next
+    instruction and unreachable code are removed, and SET is removed where
+    no op reads the switch before a test sets it again. CLL and R count as
+    reading it. Every branch target is left with a single label.
+    """
+    program = link(code)
+    ops = [OPS[op] for op in program.ops]
+    args = list(program.args)
+    labels = [[] for _ in range(len(ops) + 1)]
+    for label, pc in program.label_to_pc.items():
+        labels[pc].append(label)
+    rules = {arg for op, arg in zip(ops, args) if op in ("CLL", "ADR")}
+    rule_labels = {label for pc in rules for label in labels[pc]}
+    report = OrderedDict((change, 0) for change in OPTIMIZATIONS)
+
+    while True:
+        changed = False
+        for pc, op in enumerate(ops):
+            if op not in ("B", "BT", "BF"):
+                continue
+            target = _thread(ops, args, op, args[pc])
+            if op == "B" and target < len(ops) and ops[target] in ("R",
+                                                                 "END"):
+                ops[pc], args[pc] = ops[target], None
+            elif target != args[pc]:
+                args[pc] = target
+            else:
+                continue
+            report["branches threaded"] += 1
+            changed = True
+
+        removed = {pc for pc, op in enumerate(ops)
+                   if op in ("B", "BT", "BF") and args[pc] == pc + 1}
+        report["branches removed"] += len(removed)
+
+        reached = set()
+        pending = [0]
+        while pending:
+            pc = pending.pop()
+            if pc in reached or pc >= len(ops):
+                continue
+            reached.add(pc)
+            if ops[pc] in LABEL_OPS:
+                pending.append(args[pc])
+            if ops[pc] not in BLOCK_END_OPS:
+                pending.append(pc + 1)
+        unreachable = {pc for pc, op in enumerate(ops)
+                       if pc not in reached and op != "END"} - removed
+        report["unreachable removed"] += len(unreachable)
+        removed |= unreachable
+
+        targets = {arg for op, arg in zip(ops, args) if op in LABEL_OPS}
+        for pc, op in enumerate(ops):
+            if op not in ("BT", "BF", "BE") or pc in removed:
+                continue
+            switch = _switch_known(ops, targets, pc)
+            if switch is None or op == "BE" and not switch:
+                continue
+            if op == "BE":
+                removed.add(pc)
+                report["BE removed"] += 1
+            elif switch == (op == "BT"):
+                ops[pc] = "B"
+                report["branches resolved"] += 1
+                changed = True
+            else:
+                removed.add(pc)
+                report["branches resolved"] += 1
+
+        live = _switch_live(ops, args)
+        for pc, op in enumerate(ops):
+            if op == "SET" and pc not in removed and not live[pc + 1]:
+                removed.add(pc)
+                report["SET removed"] += 1
+
+        if not removed and not changed:
+            break
+        ops, args, labels = _compact(ops, args, labels, removed)
+
+    # one label per branch target, preferring rule names
+    names = {}
+    counter = 0
+    used = {label for pc_labels in labels for label in pc_labels}
+    for pc in sorted(arg for op, arg in zip(ops, args) if op in LABEL_OPS):
+        if pc in names:
+            continue
+        for label in labels[pc]:
+            if label in rule_labels:
+                break
+        else:
+            label = labels[pc][0] if labels[pc] else None
+        while label is None or label in used and label not in labels[pc]:
+            counter += 1
+            label = "L{}".format(counter)
+        used.add(label)
+        names[pc] = label
+    report["labels removed"] = len(program.label_to_pc) - len(
+        set(names.values()) & set(program.label_to_pc))
+
+    code = [Inst(op=op, arg=names[arg] if op in LABEL_OPS else arg,
+                 labels=[names[pc]] if pc in names else [])
+            for pc, (op, arg) in enumerate(zip(ops, args))]
+    return code, report
+
+
+def _thread(ops, args, op, target):
+    """Final target of a branch op to target, following B and the BT or BF
+    branches whose outcome is known.
+    """
+    seen = set()
+    while target < len(ops) and target not in seen:
+        seen.add(target)
+        if ops[target] == "B":
+            target = args[target]
+        elif op != "B" and ops[target] in ("BT", "BF"):
+            target = args[target] if ops[target] == op else target + 1
+        else:
+            break
+    return target
+
+
+def _switch_known(ops, targets, pc):
+    """The switch when the op at pc runs, or None if not known."""
+    while pc > 0 and pc not in targets:
+        pc -= 1
+        if ops[pc] in ("SET", "BF", "BE"):
+            return True
+        if ops[pc] == "BT":
+            return False
+        if ops[pc] not in SWITCH_TRANSPARENT_OPS:
+            break
+    return None
+
+
+def _switch_live(ops, args):
+    """For each pc, whether the switch may be read before it is set again
+    when execution gets there.
+    """
+    live = [False] * len(ops) + [True]
+    changed = True
+    while changed:
+        changed = False
+        for pc in reversed(range(len(ops))):
+            op = ops[pc]
+            if op in SWITCH_SET_OPS:
+                value = False
+            elif op in ("B", "ADR"):
+                value = live[args[pc]]
+            elif op in SWITCH_TRANSPARENT_OPS:
+                value = live[pc + 1]
+            else:
+                value = True
+            if value != live[pc]:
+                live[pc] = value
+                changed = True
+    return live
+
+
+def _compact(ops, args, labels, removed):
+    """Drop the removed pcs, moving their labels and branches to them on to
+    the next instruction kept.
+    """
+    new_pc = []
+    kept = 0
+    for pc in range(len(ops)):
+        new_pc.append(kept)
+        if pc not in removed:
+            kept += 1
+    new_pc.append(kept)
+
+    new_labels = [[] for _ in range(kept + 1)]
+    for pc, pc_labels in enumerate(labels):
+        new_labels[new_pc[pc]].extend(pc_labels)
+    keep = [pc for pc in range(len(ops)) if pc not in removed]
+    return ([ops[pc] for pc in keep],
+            [new_pc[args[pc]] if ops[pc] in LABEL_OPS else args[pc]
+             for pc in keep],
+            new_labels)
+
+
+def format_code(code):
+    """META II code text for a list of Inst, the inverse of parse_code."""
+    lines = []
+    for instr in code:
+        lines.extend(instr.labels)
+        if instr.arg is None:
+            lines.append("        " + instr.op)
+        elif instr.op in LABEL_OPS:
+            lines.append("        {} {}".format(instr.op, instr.arg))
+        else:
+            lines.append("        {} '{}'".format(instr.op, instr.arg))
+    return "".join(line + "\n" for line in lines)
+
+
+# FIRST sets of scanning ops: the characters a match can start with, and
+# whether it can start with characters outside of those (Unicode digits)
+FIRST = {
+    "ID": (frozenset("abcdefghijklmnopqrstuvwxyz"
+                     "ABCDEFGHIJKLMNOPQRSTUVWXYZ"), False),
+    "NUM": (frozenset("0123456789"), True),
+    "SR": (frozenset("'"), False),
+}
+
+
+def dispatch_index(program):
+    """FIRST-set analysis of alternatives, cached on the program.
+
+    From every rule entry and branch target starting with a test (a scanning
+    op or a call of a rule that fails cleanly), this follows the path the
+    code takes when every test fails. Along such a path only failed tests,
+    taken BF branches, untaken BT ones and B branches are executed. When
+    the path passes at least two tests, the next non-space character decides
+    the only place the code can go: the first test that can match it, or
+    where the path ends. Returns {pc: (table, other)}, where table maps
+    ASCII characters, the first characters of TST literals and None (end of
+    input) to a target pc, and other is the target for any other character.
+    """
+    if program.dispatch is not None:
+        return program.dispatch
+
+    ops = [OPS[op] for op in program.ops]
+    args = program.args
+    rule_firsts = {}
+
+    def test_first(pc):
+        """FIRST of the test at pc, None for any input, or False if pc is not
+        a test.
+        """
+        op = ops[pc]
+        if op == "TST":
+            return (frozenset(args[pc][:1]), False) if args[pc] else None
+        if op in FIRST:
+            return FIRST[op]
+        if op == "CLL":
+            return rule_first(args[pc])
+        return False
+
+    def rule_first(entry):
+        # a rule fails cleanly if it gets to R through failed tests only
+        if entry not in rule_firsts:
+            rule_firsts[entry] = False
+            tests, end = fail_path(entry)
+            if tests and end < len(ops) and ops[end] == "R":
+                firsts = [first for _, first in tests]
+                if None not in firsts:
+                    rule_firsts[entry] = (
+                        frozenset().union(*(chars for chars, _ in firsts)),
+                        any(other for _, other in firsts))
+        return rule_firsts[entry]
+
+    def fail_path(pc):
+        tests = []
+        seen = set()
+        while pc < len(ops) and pc not in seen:
+            seen.add(pc)
+            op = ops[pc]
+            first = test_first(pc)
+            if first is not False:
+                tests.append((pc, first))
+                pc += 1
+            elif op == "BF" and tests:
+                pc = args[pc]
+            elif op == "BT" and tests:
+                pc += 1
+            elif op == "B":
+                pc = args[pc]
+            else:
+                break
+        return tests, pc
+
+    def target(tests, end, char):
+        for pc, first in tests:
+            if first is None:
+                return pc
+            chars, other = first
+            if char is None:
+                continue
+            if char in chars or other and char not in ASCII:
+                return pc
+        return end
+
+    heads = {0} | {arg for op, arg in zip(ops, args) if op in LABEL_OPS}
+    dispatch = {}
+    for head in sorted(heads):
+        if head >= len(ops) or test_first(head) is False:
+            continue
+        tests, end = fail_path(head)
+        if len(tests) < 2:
+            continue
+
+        keys = set(ASCII) | {None}
+        for _, first in tests:
+            if first:
+                keys |= first[0]
+        table = {char: target(tests, end, char) for char in keys}
+        other = target(tests, end, "\U0010ffff")
+        dispatch[head] = (table, other)
+
+    program.dispatch = dispatch
+    return dispatch
+
+
+def load_program(source, cache=None, optimized=False):
+    """Parse and link META II code text, going through the cache (a
+    ProgramCache) when given one. Bytes are either bytecode (see assemble),
+    which is loaded as is, or encoded code text. With optimized, the code
+    goes through optimize first.
+    """
+    if isinstance(source, bytes):
+        if source.startswith(MBC_MAGIC):
+            program = load_bytecode(source)
+            return link(optimize(program)[0]) if optimized else program
+        source = io.TextIOWrapper(io.BytesIO(source)).read()
+
+    key_source = "optimize\n" + source if optimized else source
+    if cache is not None:
+        program = cache.load(key_source)
+        if program is not None:
+            return program
+
+    code = parse_code(source.splitlines(keepends=True))
+    program = link(optimize(code)[0] if optimized else code)
+
+    if cache is not None:
+        cache.store(key_source, program)
+    return program
+
+
+def load_pipeline(code, sources, cache=None):
+    """Load code (see load_program), run it over sources[0] and load the
+    code it generates, run that over sources[1], and so on. Returns the last
+    Program. Generated code goes straight from VM.iter_run to parse_code,
+    with no intermediate text. With a cache (a ProgramCache), generated
+    programs are cached under a hash of the code and source they came from.
+    Raises ValueError when a source fails to parse.
+    """
+    program = (load_program(code, cache) if isinstance(code, (str, bytes))
+               else link(code))
+    key = cache.key(assemble(program).hex()) if cache is not None else None
+
+    for i, source in enumerate(sources):
+        if cache is not None:
+            key_source = "pipeline {}\n{}".format(key, source)
+            key = cache.key(key_source)
+            cached = cache.load(key_source)
+            if cached is not None:
+                program = cached
+                continue
+
+        vm = VM(source)
+        try:
+            generated = parse_code(vm.iter_run(program))
+        except ValueError as e:
+            raise ValueError("source {} generated bad code: {}".format(
+                i + 1, e)) from None
+        if vm.is_err:
+            raise ValueError("source {} failed to parse".format(i + 1))
+        if not generated:
+            raise ValueError("source {} generated no code".format(i + 1))
+        program = link(generated)
+
+        if cache is not None:
+            cache.store(key_source, program)
+    return program
+
+
+class ProgramCache:
+    """On-disk cache of linked programs keyed by a hash of the code text and
+    the VM version. Entries are marshalled Program fields, written atomically.
+    Hits refresh an entry's mtime, and the least recently used entries are
+    evicted once the cache grows over max_bytes.
+    """
+
+    def __init__(self, path=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def key(self, source):
+        import hashlib
+
+        digest = hashlib.sha256()
+        digest.update("{} {}\n".format(__version__, sys.version_info[:2])
+                      .encode())
+        digest.update(source.encode())
+        return digest.hexdigest()
+
+    def entry_path(self, source):
+        return os.path.join(self.path, self.key(source) + ".masmc")
+
+    def load(self, source):
+        path = self.entry_path(source)
+        try:
+            with open(path, "rb") as f:
+                ops, args, label_to_pc = marshal.load(f)
+            os.utime(path)
+        except (OSError, EOFError, ValueError, TypeError):
+            return None
+        return Program(ops, args, label_to_pc)
+
+    def store(self, source, program):
+        data = marshal.dumps((program.ops.tobytes(), program.args,
+                              program.label_to_pc))
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            import tempfile
+
+            fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self.entry_path(source))
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self.evict()
+        except OSError:
+            # the cache is an optimization only
+            pass
+
+    def evict(self):
+        entries = []
+        total = 0
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith(".masmc"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+class Halt(Exception):
+    """Raised by compiled code to stop the VM on END or a BE error."""
+
+
+# Execution engines accepted by VM.run
+ENGINES = ("interp", "compiled")
+
+# Ops ending a basic block: control never falls through them
+BLOCK_END_OPS = frozenset(("R", "B", "ADR", "END"))
+
+
+def program_source(program):
+    """Generate Python source for a linked program.
+
+    Every CLL target (and the code at pc 0) becomes a nested function of
+    bind(vm). Label cells of a stackframe become the function's locals, the
+    switch is passed in and returned, and branches inside a function jump
+    between its basic blocks through a local block variable. Blocks are laid
+    out in pc order, so falling through to the next block costs nothing.
+    """
+    ops = [OPS[op] for op in program.ops]
+    args = program.args
+
+    entries = [0] + sorted({args[pc] for pc, op in enumerate(ops)
+                            if op == "CLL"} - {0})
+
+    lines = ["def bind(vm):",
+             "    scan_string = vm.scan_string",
+             "    scan_token = vm.scan_token",
+             "    dump_output = vm.dump_output",
+             "    label_generate = vm.label_generate",
+             ""]
+    for entry in entries:
+        lines.extend(_function_source(program, ops, entry))
+        lines.append("")
+    lines.append("    return r{}".format(entries[0]))
+
+    return "\n".join(lines) + "\n"
+
+
+def _function_source(program, ops, entry):
+    args = program.args
+
+    # Find the blocks reachable from entry without following calls
+    leaders = {entry}
+    pending = [entry]
+    while pending:
+        pc = pending.pop()
+        while pc < len(ops):
+            op = ops[pc]
+            if op in ("B", "BT", "BF", "ADR") and args[pc] not in leaders:
+                leaders.add(args[pc])
+                pending.append(args[pc])
+            if op in BLOCK_END_OPS:
+                break
+            pc += 1
+            if pc in leaders:
+                break
+        else:
+            if pc not in leaders:
+                leaders.add(pc)
+
+    labels = sorted(label for label, pc in program.label_to_pc.items()
+                    if pc == entry)
+    body = ["    def r{}(sw):{}".format(
+                entry, "  # " + ", ".join(labels) if labels else ""),
+            "        l1 = l2 = None",
+            "        block = {}".format(entry),
+            "        while True:"]
+    for leader in sorted(leaders):
+        body.append("            if block == {}:".format(leader))
+        if leader >= len(ops):
+            body.append("                raise IndexError("
+                        "'pc {} out of range')".format(leader))
+            continue
+        pc = leader
+        while True:
+            body.extend("                " + line
+                        for line in _op_source(ops[pc], args[pc]))
+            if ops[pc] in BLOCK_END_OPS:
+                break
+            pc += 1
+            if pc in leaders:
+                body.append("                block = {}".format(pc))
+                break
+
+    return body
+
+
+def _op_source(op, arg):
+    if op == "TST":
+        return ["sw = scan_string({!r})".format(arg)]
+    if op in ("ID", "NUM", "SR"):
+        return ["sw = scan_token({}_RE)".format(op)]
+    if op == "CLL":
+        return ["sw = r{}(sw)".format(arg)]
+    if op == "R":
+        return ["return sw"]
+    if op == "SET":
+        return ["sw = True"]
+    if op in ("B", "ADR"):
+        return ["block = {}".format(arg), "continue"]
+    if op == "BT":
+        return ["if sw:", "    block = {}".format(arg), "    continue"]
+    if op == "BF":
+        return ["if not sw:", "    block = {}".format(arg), "    continue"]
+    if op == "BE":
+        return ["if not sw:", "    vm.is_err = True", "    raise Halt"]
+    if op == "CL":
+        return ["vm.output_buf.append({!r})".format(arg)]
+    if op == "CI":
+        return ["vm.output_buf.append(str(vm.token_buf))"]
+    if op == "GN1":
+        return ["if l1 is None:", "    l1 = label_generate()",
+                "vm.output_buf.append(l1)"]
+    if op == "GN2":
+        return ["if l2 is None:", "    l2 = label_generate()",
+                "vm.output_buf.append(l2)"]
+    if op == "LB":
+        return ["vm.output_col = 0"]
+    if op == "OUT":
+        return ["dump_output()", "vm.output_col = 8"]
+    if op == "END":
+        return ["vm.is_done = True", "raise Halt"]
+    raise ValueError("Unknown op: {}".format(op))
+
+
+def compile_program(program):
+    """Compile a linked program into Python code, returning its bind(vm)
+    function. The result is cached on the program.
+    """
+    if program.compiled is None:
+        namespace = {"Halt": Halt, "ID_RE": regex("ID"),
+                     "NUM_RE": regex("NUM"), "SR_RE": regex("SR")}
+        exec(compile(program_source(program), "<metaii program>", "exec"),
+             namespace)
+        program.compiled = namespace["bind"]
+    return program.compiled
+
+
+# Line prefixes for the output columns LB and OUT set
+INDENTS = {0: "", 8: " " * 8}
+
+
+class OutputWriter:
+    """Buffered writer for output lines.
+
+    The flush policy is "line" to write every line as it comes, "end" to
+    write everything on flush() only, or a number of characters to buffer
+    before writing. Output goes to a text file, or, given an encoding, to a
+    binary file. A file descriptor is written to as a binary file, in UTF-8
+    by default.
+    """
+
+    def __init__(self, file, flush="line", encoding=None):
+        if isinstance(file, int):
+            file = open(file, "wb", buffering=0, closefd=False)
+            encoding = encoding or "utf-8"
+        self.file = file
+        self.encoder = (codecs.getincrementalencoder(encoding)()
+                        if encoding else None)
+
+        if flush == "line":
+            self.limit = 0
+        elif flush == "end":
+            self.limit = None
+        elif isinstance(flush, int) and flush > 0:
+            self.limit = flush
+        else:
+            raise ValueError("Unknown flush policy: {!r}".format(flush))
+
+        self.lines = []
+        self.size = 0
+
+    def write_record(self, col, fragments):
+        """Write the line starting at column col made of fragments. This is
+        how the VM emits lines to its sink.
+        """
+        self.write_line(INDENTS[col] + "".join(fragments) + "\n")
+
+    def write_line(self, line):
+        if self.limit == 0:
+            self.write(line)
+            return
+
+        self.lines.append(line)
+        self.size += len(line)
+        if self.limit is not None and self.size >= self.limit:
+            self.write("".join(self.lines))
+            self.lines = []
+            self.size = 0
+
+    def write(self, text):
+        if self.encoder:
+            text = self.encoder.encode(text)
+        self.file.write(text)
+
+    def flush(self):
+        if self.lines:
+            self.write("".join(self.lines))
+            self.lines = []
+            self.size = 0
+        if hasattr(self.file, "flush"):
+            self.file.flush()
+
+
+class LineBuffer:
+    """Output sink keeping lines in memory, for VM.iter_run."""
+
+    file = None
+
+    def __init__(self):
+        self.lines = []
+
+    def write_record(self, col, fragments):
+        self.lines.append(INDENTS[col] + "".join(fragments) + "\n")
+
+    def flush(self):
+        pass
+
+
+class LineCounter:
+    """Output sink counting lines and characters without building them."""
+
+    file = None
+
+    def __init__(self):
+        self.lines = 0
+        self.chars = 0
+
+    def write_record(self, col, fragments):
+        self.lines += 1
+        self.chars += col + sum(map(len, fragments)) + 1
+
+    def flush(self):
+        pass
+
+
+def parse_size(text):
+    """Parse a size like 512, 64K or 1M."""
+    units = {"K": 1 << 10, "M": 1 << 20}
+    text = text.strip().upper()
+    try:
+        if text and text[-1] in units:
+            return int(float(text[:-1]) * units[text[-1]])
+        return int(text)
+    except ValueError:
+        import argparse
+        raise argparse.ArgumentTypeError(
+            "expected a size, got {!r}".format(text))
+
+
+def flush_policy(text):
+    """Parse a --flush value: "line", "end" or a size like 64K or 1M."""
+    if text in ("line", "end"):
+        return text
+    return parse_size(text)
+
+
+class MemoTable:
+    """Packrat memo of rule calls for VM.run(code, memo=...).
+
+    Results are keyed by the called rule and everything the call depends on:
+    the input position, the switch, the token buffer and the output column.
+    Each holds the resulting switch, position, token buffer and output
+    column, and the fragments added to the output buffer. At most
+    max_entries results are kept, least recently used ones being evicted.
+    """
+
+    def __init__(self, max_entries=1 << 16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.skipped = 0
+        self.evicted = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def get(self, key):
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self.entries[key] = result
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evicted += 1
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses,
+                "skipped": self.skipped, "evicted": self.evicted,
+                "entries": len(self.entries)}
+
+
+# Snapshot format version, and instructions between checkpoints
+SNAPSHOT_VERSION = 1
+CHECKPOINT_EVERY = 1000000
+
+
+class Checkpoint:
+    """Periodic snapshots of a run (see VM.snapshot), for VM.run. Every
+    `every` instructions the output is flushed and the snapshot is written
+    to path atomically, along with the output file position where the run
+    got to, or None if the output file can't tell. input_id is anything
+    marshallable identifying the input (see input_id); a checkpoint of
+    another input is not loaded.
+    """
+
+    def __init__(self, path, every=CHECKPOINT_EVERY, input_id=None):
+        if every < 1:
+            raise ValueError("Checkpoints must be at least 1 instruction "
+                             "apart")
+        self.path = path
+        self.every = every
+        self.input_id = input_id
+
+    def save(self, vm):
+        vm.output.flush()
+        try:
+            position = vm.output_file.tell()
+        except (AttributeError, OSError, ValueError):
+            position = None
+        data = marshal.dumps((vm.snapshot(), position, self.input_id))
+
+        import tempfile
+
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def load(self):
+        """The saved snapshot and output position, or None if there is no
+        checkpoint. Raises ValueError if the checkpoint is of another input.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                snapshot, position, input_id = marshal.load(f)
+        except FileNotFoundError:
+            return None
+        except (EOFError, ValueError, TypeError) as e:
+            raise ValueError("Corrupt checkpoint {}: {}".format(self.path, e))
+        if input_id != self.input_id:
+            raise ValueError("Checkpoint {} is of another input".format(
+                self.path))
+        return snapshot, position
+
+    def remove(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class Profiler:
+    """Execution statistics of a VM.run: instructions executed per opcode,
+    and per rule (CLL target) the number of calls, the instructions executed
+    and the wall time spent inside the rule (inclusive) or in its own code
+    (exclusive), and the input characters consumed. Code outside of any
+    call is accounted to the "(top)" rule.
+    """
+
+    def __init__(self):
+        self.op_counts = [0] * len(OPS)
+        # entry pc -> [calls, incl. instrs, excl. instrs, incl. seconds,
+        #              excl. seconds, chars]
+        self.rules = {}
+        self.label_to_pc = {}
+
+        # frames: [entry pc, start count, start time, start offset,
+        #          child instrs, child seconds]
+        self.frames = []
+        # entry pc -> calls currently on the stack, so that recursive calls
+        # are only counted once in inclusive figures
+        self.active = {}
+
+    def enter(self, entry, count, now, offset):
+        self.frames.append([entry, count, now, offset, 0, 0.0])
+        self.active[entry] = self.active.get(entry, 0) + 1
+
+    def exit(self, count, now, offset):
+        entry, start_count, start, start_offset, child_instrs, child_seconds = \
+            self.frames.pop()
+        instrs = count - start_count
+        seconds = now - start
+        self.active[entry] -= 1
+
+        stats = self.rules.setdefault(entry, [0, 0, 0, 0.0, 0.0, 0])
+        stats[0] += 1
+        if not self.active[entry]:
+            stats[1] += instrs
+            stats[3] += seconds
+            stats[5] += offset - start_offset
+        stats[2] += instrs - child_instrs
+        stats[4] += seconds - child_seconds
+
+        if self.frames:
+            self.frames[-1][4] += instrs
+            self.frames[-1][5] += seconds
+
+    def exit_all(self, count, now, offset):
+        while self.frames:
+            self.exit(count, now, offset)
+
+    def rule_name(self, entry):
+        return rule_name(self.label_to_pc, entry)
+
+    def as_dict(self):
+        return {
+            "rules": {
+                self.rule_name(entry): {
+                    "calls": calls, "instrs": instrs,
+                    "own_instrs": own_instrs, "seconds": seconds,
+                    "own_seconds": own_seconds, "chars": chars,
+                }
+                for entry, (calls, instrs, own_instrs, seconds, own_seconds,
+                            chars) in self.rules.items()
+            },
+            "ops": {op: count for op, count in zip(OPS, self.op_counts)
+                    if count},
+        }
+
+    def table(self):
+        """The statistics as text, rules sorted by exclusive instructions."""
+        stats = self.as_dict()
+        lines = ["{:<16} {:>8} {:>10} {:>10} {:>10} {:>10} {:>8}".format(
+            "rule", "calls", "instrs", "own", "ms", "own ms", "chars")]
+        for name, rule in sorted(stats["rules"].items(),
+                                 key=lambda item: -item[1]["own_instrs"]):
+            lines.append(
+                "{:<16} {:>8} {:>10} {:>10} {:>10.3f} {:>10.3f} {:>8}".format(
+                    name, rule["calls"], rule["instrs"], rule["own_instrs"],
+                    rule["seconds"] * 1e3, rule["own_seconds"] * 1e3,
+                    rule["chars"]))
+        lines.append("")
+        lines.append("{:<16} {:>8}".format("op", "count"))
+        for op, count in sorted(stats["ops"].items(),
+                                key=lambda item: -item[1]):
+            lines.append("{:<16} {:>8}".format(op, count))
+        return "\n".join(lines) + "\n"
+
+
+def rule_name(label_to_pc, entry):
+    """Name of the rule starting at pc entry, None for the top level."""
+    if entry is None:
+        return "(top)"
+    labels = [label for label, pc in label_to_pc.items() if pc == entry]
+    return labels[0] if labels else "@{}".format(entry)
+
+
+class LimitError(Exception):
+    """A run went over a VM limit. kind is "depth" (max_depth calls),
+    "output" (max_output characters in the output buffer) or "recursion"
+    (the Python recursion limit, in the compiled engine). rule is the rule
+    being called or run, depth the call depth and offset the input offset.
+    """
+
+    def __init__(self, kind, limit, rule, depth, offset):
+        super().__init__(
+            "{} limit of {} exceeded{} (input offset {})".format(
+                kind, limit,
+                "" if rule is None else
+                " in rule {} at call depth {}".format(rule, depth),
+                offset))
+        self.kind = kind
+        self.limit = limit
+        self.rule = rule
+        self.depth = depth
+        self.offset = offset
+
+
+RunResult = namedtuple("RunResult", ["output", "ok", "seconds", "error"],
+                       defaults=[None])
+
+
+# Streamed input is read this many characters at a time, and refilled
+# whenever fewer than INPUT_LOOKAHEAD characters are left after spaces
+INPUT_CHUNK = 1 << 20
+INPUT_LOOKAHEAD = 1 << 12
+
+# Instructions VM.aiter_run executes between yields to the event loop
+ASYNC_SLICE = 1000
+
+
+class _NeedInput(Exception):
+    """Raised by AsyncInput when the VM reads ahead of the received text."""
+
+
+class AsyncInput:
+    """Input stream standing in for an async one (anything with a coroutine
+    read(size) returning text or UTF-8 bytes) while VM.aiter_run runs. The
+    VM reads the text fed so far; reading past it raises _NeedInput, and
+    aiter_run awaits the next chunk and runs the instruction again.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.eof = False
+
+    async def receive(self, size):
+        data = await self.source.read(size)
+        if isinstance(data, bytes):
+            self.text += self.decoder.decode(data, final=not data)
+        else:
+            self.text += data
+        self.eof = not data
+
+    def read(self, size):
+        if not self.text and not self.eof:
+            raise _NeedInput
+        chunk = self.text[:size]
+        self.text = self.text[size:]
+        return chunk
+
+
 class VM:
 
-    def __init__(self, input_buf, output_file=sys.stdout):
+    __slots__ = (
+        "dispatch", "flush", "encoding", "output",
+        "input_chunk", "input_lookahead", "input_base", "input_stream",
+        "input_buf", "input_buf_index", "space_end",
+        "token_buf", "output_buf", "output_col",
+        "label_counter", "frames", "pc", "switch", "is_err", "is_done",
+        "label_to_pc", "program", "memo", "memo_frames",
+        "max_depth", "max_output", "output_size",
+    )
+
+    def __init__(self, input_buf, output_file=sys.stdout, flush="line",
+                 encoding=None, dispatch=True, max_depth=None,
+                 max_output=None):
+        self.dispatch = dispatch
+        self.max_depth = max_depth
+        self.max_output = max_output
+        self.input_chunk = INPUT_CHUNK
+        self.input_lookahead = INPUT_LOOKAHEAD
+        self.flush = flush
+        self.encoding = encoding
         self.output_file = output_file
 
         self.reset(input_buf)
 
+    @property
+    def output_file(self):
+        return self.output.file
+
+    @output_file.setter
+    def output_file(self, output_file):
+        """A file to write to, or a sink like LineCounter, taking each line
+        as a write_record(col, fragments) call.
+        """
+        if hasattr(output_file, "write_record"):
+            self.output = output_file
+        else:
+            self.output = OutputWriter(output_file, self.flush, self.encoding)
+
     def reset(self, input_buf):
-        self.input_buf = input_buf
+        """Start over on new input: either a string or a text stream. A
+        stream is read in chunks into a sliding window, input_buf, which
+        drops the text before the current position on every refill. META II
+        never backtracks, so memory stays bounded by the window size.
+        """
+        self.input_base = 0
+        if isinstance(input_buf, str):
+            self.input_stream = None
+            self.input_buf = input_buf
+        else:
+            self.input_stream = input_buf
+            self.input_buf = ""
         self.input_buf_index = 0
+        self.space_end = -1
 
         self.token_buf = None
         self.output_buf = []
+        self.output_size = 0
         self.output_col = 8
 
         self.label_counter = 1
-        self.label1_stack = [None]
-        self.label2_stack = [None]
-        self.call_stack = []
+        # stack frames of three cells: label 1, label 2 and the location to
+        # return to; the bottom one holds the labels of the top level code
+        self.frames = [None, None, None]
         self.pc = 0
 
         self.switch = False
@@ -83,155 +2059,542 @@ class VM:
         self.is_done = False
 
         self.label_to_pc = {}
+        self.program = None
+
+        self.memo = None
+        self.memo_frames = []
+
+    def run(self, code, trace=False, engine="interp", profile=None,
+            memo=None, checkpoint=None):
+        """Run either a list of Inst or an already linked Program. The engine
+        is one of ENGINES: the instruction interpreter or the code compiled
+        to Python functions (see compile_program), which does not trace,
+        profile or memoize. A Profiler passed as profile collects execution
+        statistics, a MemoTable passed as memo memoizes rule calls, and a
+        Checkpoint passed as checkpoint saves snapshots along the way. The
+        run goes on from where the VM is, which after restore is the
+        snapshot.
+        """
+        self.execute(link(code), trace, engine, profile, memo, checkpoint)
 
-    def run(self, code, trace=False):
-        # setup labels
-        for i, instr in enumerate(code):
-            for label in instr.labels:
-                self.label_to_pc[label] = i
+        if self.is_err:
+            print("Failed to parse input!", file=sys.stderr)
 
+    def run_many(self, code, inputs, engine="interp"):
+        """Run code over each input string in turn, resetting the VM in
+        between. This is a generator yielding a RunResult per input: parse
+        failures are reported there and do not stop the batch.
+        """
+        program = link(code)
+        output = self.output
+        try:
+            for input_buf in inputs:
+                self.reset(input_buf)
+                self.output_file = io.StringIO()
+
+                start = time.perf_counter()
+                try:
+                    self.execute(program, engine=engine)
+                    error = "Failed to parse input!" if self.is_err else None
+                except LimitError as e:
+                    error = str(e)
+                seconds = time.perf_counter() - start
+
+                yield RunResult(self.output_file.getvalue(), error is None,
+                                seconds, error)
+        finally:
+            self.output = output
+
+    async def aiter_run(self, code, slice_size=ASYNC_SLICE):
+        """Run code with the interpreter as an async generator of output
+        lines, like iter_run, giving the event loop a turn every slice_size
+        instructions. The input can be an async stream (see AsyncInput).
+        """
+        output = self.output
+        self.output = LineBuffer()
+        lines = self.output.lines
+        try:
+            async for _ in self._run_slices(code, slice_size):
+                for line in lines:
+                    yield line
+                lines.clear()
+        finally:
+            self.output = output
+
+    async def run_async(self, code, writer=None, slice_size=ASYNC_SLICE):
+        """Run code like run without blocking the event loop (see
+        aiter_run). Output goes to writer when given, an async stream like
+        asyncio.StreamWriter taking encoded lines, or else to output_file.
+        """
+        try:
+            if writer is None:
+                async for _ in self._run_slices(code, slice_size):
+                    pass
+            else:
+                encoding = self.encoding or "utf-8"
+                async for line in self.aiter_run(code, slice_size):
+                    writer.write(line.encode(encoding))
+                    await writer.drain()
+        finally:
+            self.output.flush()
+
+    async def _run_slices(self, code, slice_size):
+        import asyncio
+        import inspect
+
+        if slice_size < 1:
+            raise ValueError("slice_size must be at least 1")
+        program = link(code)
+        self.label_to_pc = program.label_to_pc
+        self.program = program
+
+        steps, args = self.bind(program)
+
+        stream = self.input_stream
+        if stream is not None and inspect.iscoroutinefunction(stream.read):
+            stream = self.input_stream = AsyncInput(stream)
         while not self.is_err and not self.is_done:
-            instr = code[self.pc]
-            handler = getattr(self, "op_" + instr.op)
-            if trace:
-                input_buf = self.input_buf[self.input_buf_index:]
-                print(instr,
-                      ", input_buf='{}'".format(input_buf),
-                      ", token_buf='{}'".format(self.token_buf),
-                      ", call_stack='{}'".format(self.call_stack),
-                      ", output_buf='{}'".format(self.output_buf),
-                      file=sys.stderr)
-            handler(instr.arg)
+            try:
+                for _ in repeat(None, slice_size):
+                    pc = self.pc
+                    steps[pc](args[pc])
+                    if self.is_err or self.is_done:
+                        break
+            except _NeedInput:
+                # the instruction only got past spaces, and runs again once
+                # more input is in
+                await stream.receive(self.input_chunk)
+            yield
+            await asyncio.sleep(0)
 
         if self.is_err:
             print("Failed to parse input!", file=sys.stderr)
 
+    def iter_run(self, code):
+        """Run code with the interpreter, yielding each output line (with its
+        line terminator) as soon as OUT emits it instead of writing it to
+        output_file.
+        """
+        program = link(code)
+        self.label_to_pc = program.label_to_pc
+        self.program = program
+
+        steps, args = self.bind(program)
+
+        output = self.output
+        self.output = LineBuffer()
+        lines = self.output.lines
+        try:
+            while not self.is_err and not self.is_done:
+                pc = self.pc
+                steps[pc](args[pc])
+                if lines:
+                    yield from lines
+                    lines.clear()
+        finally:
+            self.output = output
+
+        if self.is_err:
+            print("Failed to parse input!", file=sys.stderr)
+
+    def execute(self, program, trace=False, engine="interp", profile=None,
+                memo=None, checkpoint=None):
+        self.label_to_pc = program.label_to_pc
+        self.program = program
+        self.memo = memo
+        if memo is not None:
+            memo.clear()
+
+        try:
+            if engine == "interp":
+                self.run_interp(program, trace, profile, checkpoint)
+            elif (engine == "compiled" and not trace and profile is None and
+                  memo is None and self.max_depth is None and
+                  self.max_output is None and checkpoint is None and
+                  self.pc == 0):
+                self.run_compiled(program)
+            elif engine == "compiled":
+                raise ValueError("The compiled engine can't trace, profile, "
+                                 "memoize, enforce limits, checkpoint or "
+                                 "resume")
+            else:
+                raise ValueError("Unknown engine: {}".format(engine))
+        finally:
+            self.output.flush()
+
+    def bind(self, program):
+        """The handler and argument of every instruction of program, for the
+        interpreter loops. Token ops take their pattern as argument. With
+        dispatch on, the first tests of alternatives go through op_dispatch.
+        """
+        handlers = self.handlers()
+        steps = [handlers[op] for op in program.ops]
+        # token ops get their compiled patterns
+        args = [regex(OPS[op]) if op in TOKEN_OPCODES else arg
+                for op, arg in zip(program.ops, program.args)]
+
+        if self.dispatch:
+            for pc, (table, other) in dispatch_index(program).items():
+                args[pc] = (pc, table, other, steps[pc], args[pc])
+                steps[pc] = self.op_dispatch
+
+        return steps, args
+
+    def run_interp(self, program, trace=False, profile=None,
+                   checkpoint=None):
+        steps, args = self.bind(program)
+
+        if trace:
+            self.run_trace(program, steps, args)
+        elif profile is not None:
+            self.run_profile(program, steps, args, profile)
+        elif checkpoint is not None:
+            self.run_checkpoint(steps, args, checkpoint)
+        else:
+            while not self.is_err and not self.is_done:
+                pc = self.pc
+                steps[pc](args[pc])
+
+    def run_compiled(self, program):
+        entry = compile_program(program)(self)
+        try:
+            self.switch = entry(self.switch)
+            self.is_done = True
+        except Halt:
+            pass
+        except RecursionError:
+            # rules are Python functions here, so deep nesting runs out of
+            # Python stack
+            raise LimitError("recursion", sys.getrecursionlimit(), None,
+                             None, self.input_offset) from None
+
+    def run_checkpoint(self, steps, args, checkpoint):
+        """The interpreter loop, saving checkpoint every checkpoint.every
+        instructions.
+        """
+        while not self.is_err and not self.is_done:
+            for _ in repeat(None, checkpoint.every):
+                pc = self.pc
+                steps[pc](args[pc])
+                if self.is_err or self.is_done:
+                    return
+            checkpoint.save(self)
+
+    def run_trace(self, program, steps, args):
+        while not self.is_err and not self.is_done:
+            pc = self.pc
+            index = self.input_buf_index
+            print(program.inst(pc),
+                  ", input_buf='{}'".format(
+                      self.input_buf[index:index + TRACE_INPUT]),
+                  ", token_buf='{}'".format(self.token_buf),
+                  ", call_stack='{}'".format(self.call_stack[-TRACE_CALLS:]),
+                  ", output_buf='{}'".format(self.output_buf),
+                  file=sys.stderr)
+            steps[pc](args[pc])
+
+    def run_profile(self, program, steps, args, profile):
+        """The interpreter loop, counting executed instructions per opcode
+        and timing every rule call for profile, a Profiler.
+        """
+        ops = program.ops
+        op_counts = profile.op_counts
+        clock = time.perf_counter
+
+        count = 0
+        profile.enter(None, count, clock(), self.input_offset)
+        while not self.is_err and not self.is_done:
+            pc = self.pc
+            op = ops[pc]
+            op_counts[op] += 1
+            count += 1
+            depth = len(self.frames)
+            steps[pc](args[pc])
+            if op == OP_CLL and len(self.frames) > depth:
+                profile.enter(self.pc, count, clock(), self.input_offset)
+            elif op == OP_R and len(self.frames) < depth:
+                profile.exit(count, clock(), self.input_offset)
+        profile.exit_all(count, clock(), self.input_offset)
+        profile.label_to_pc = program.label_to_pc
+
+    def handlers(self):
+        """Bound op handlers indexed by opcode. Label ops get their linked
+        variants, which take a pc instead of a label.
+        """
+        handlers = [getattr(self,
+                            "op_" + op + ("_pc" if op in LABEL_OPS else ""))
+                    for op in OPS]
+        if self.memo is not None:
+            handlers[OP_CLL] = self.op_CLL_memo
+            handlers[OP_R] = self.op_R_memo
+        if self.max_depth is not None:
+            handlers[OP_CLL] = self.limit_depth(handlers[OP_CLL])
+        if self.max_output is not None:
+            for op in OP_OUTPUT:
+                handlers[op] = self.limit_output(handlers[op])
+        return handlers
+
+    def limit_depth(self, handler):
+        """Wrap the CLL handler to raise a LimitError instead of going deeper
+        than max_depth calls.
+        """
+        max_cells = 3 * (self.max_depth + 1)
+
+        def step(pc):
+            if len(self.frames) >= max_cells:
+                raise self.limit_error("depth", self.max_depth, pc)
+            handler(pc)
+        return step
+
+    def limit_output(self, handler):
+        """Wrap a handler adding to the output buffer to raise a LimitError
+        once it holds more than max_output characters.
+        """
+        def step(arg):
+            handler(arg)
+            self.output_size += len(self.output_buf[-1])
+            if self.output_size > self.max_output:
+                raise self.limit_error("output", self.max_output)
+        return step
+
+    def limit_error(self, kind, limit, entry=None):
+        """A LimitError for the rule at entry, the current rule by default.
+        """
+        depth = len(self.frames) // 3 - 1
+        if entry is None and depth:
+            # the innermost call is the CLL before the return location
+            entry = self.program.args[self.frames[-1]]
+        return LimitError(kind, limit,
+                          rule_name(self.label_to_pc, entry), depth,
+                          self.input_offset)
+
+    def seek(self, offset):
+        """Move forward to offset in the whole input. Streamed text skipped
+        over is dropped without being kept in the window.
+        """
+        while (offset - self.input_base > len(self.input_buf) and
+               self.input_stream is not None):
+            chunk = self.input_stream.read(self.input_chunk)
+            if not chunk:
+                self.input_stream = None
+                break
+            self.input_base += len(self.input_buf)
+            self.input_buf = chunk
+            self.space_end = -1
+        self.input_buf_index = offset - self.input_base
+
+    def snapshot(self):
+        """The state of the run as bytes, for restore: the position in the
+        code and the input, the switch, the stack frames, the token and
+        output buffers and the label counter. Lines already written out are
+        not part of it.
+        """
+        if self.program is None:
+            raise ValueError("Nothing to snapshot before a run")
+        if self.memo is not None:
+            raise ValueError("Can't snapshot a run with memoization")
+        return marshal.dumps((
+            SNAPSHOT_VERSION, self.program.checksum(), self.pc,
+            self.input_offset, self.switch, self.is_err, self.is_done,
+            self.token_buf, self.output_buf, self.output_col,
+            self.output_size, self.label_counter, self.frames))
+
+    def restore(self, data, code):
+        """Go back to a snapshot of a run of code over the same input. The
+        VM must not have run yet; a streamed input is read up to the
+        snapshot's position and dropped. Raises ValueError if data is not a
+        snapshot of code. VM.run then resumes the run.
+        """
+        program = link(code)
+        try:
+            (version, checksum, pc, offset, switch, is_err, is_done,
+             token_buf, output_buf, output_col, output_size, label_counter,
+             frames) = marshal.loads(data)
+        except (EOFError, ValueError, TypeError) as e:
+            raise ValueError("Corrupt VM snapshot: {}".format(e))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("Not a VM snapshot version {}".format(
+                SNAPSHOT_VERSION))
+        if checksum != program.checksum():
+            raise ValueError("The snapshot is of a run of other code")
+
+        self.seek(offset)
+        self.label_to_pc = program.label_to_pc
+        self.program = program
+        self.pc = pc
+        self.switch = switch
+        self.is_err = is_err
+        self.is_done = is_done
+        self.token_buf = token_buf
+        self.output_buf = output_buf
+        self.output_col = output_col
+        self.output_size = output_size
+        self.label_counter = label_counter
+        self.frames = frames
+
+    def fork(self, output_file):
+        """A new VM going on from the state of this one, writing to
+        output_file, for trying different continuations of a shared prefix.
+        The input must be a string or a finished stream.
+        """
+        if self.input_stream is not None:
+            raise ValueError("Can't fork a VM reading a stream")
+        vm = VM(self.input_buf, output_file, self.flush, self.encoding,
+                self.dispatch, self.max_depth, self.max_output)
+        vm.input_base = self.input_base
+        vm.restore(self.snapshot(), self.program)
+        return vm
+
     def label_generate(self):
         label = "L{}".format(self.label_counter)
         self.label_counter += 1
         return label
 
     def label1(self):
-        return self.label1_stack[-1]
-
-    def label1_push(self, label):
-        self.label1_stack.append(label)
-
-    def label1_pop(self):
-        return self.label1_stack.pop()
+        return self.frames[-3]
 
     def label1_set(self, label):
-        self.label1_stack[-1] = label
+        self.frames[-3] = label
 
     def label2(self):
-        return self.label2_stack[-1]
-
-    def label2_push(self, label):
-        self.label2_stack.append(label)
-
-    def label2_pop(self):
-        return self.label2_stack.pop()
+        return self.frames[-2]
 
     def label2_set(self, label):
-        self.label2_stack[-1] = label
+        self.frames[-2] = label
 
-    def pc_set_push(self, new_pc):
-        self.call_stack.append(self.pc)
-        self.pc = new_pc
-
-    def pc_pop_set(self):
-        self.pc = self.call_stack.pop()
+    @property
+    def call_stack(self):
+        """Return locations of the active calls, innermost last."""
+        return self.frames[5::3]
 
     def input(self):
+        """Remaining input. This copies the buffer tail, so the scanning ops
+        never use it: it is kept for tracing and introspection only. For
+        streamed input this is what is left in the window.
+        """
         return self.input_buf[self.input_buf_index:]
 
-    def skip_space(self):
-        buf = self.input_buf
-        buf_len = len(self.input_buf)
-        buf_index = self.input_buf_index
-        while buf_index < buf_len and buf[buf_index].isspace():
-            buf_index += 1
-        self.input_buf_index = buf_index
+    @property
+    def input_offset(self):
+        """Position in the whole input, streamed or not."""
+        return self.input_base + self.input_buf_index
 
-    def dump_output(self):
-        for _ in range(self.output_col):
-            print(" ", file=self.output_file, end="")
+    def fill(self):
+        """Slide the streamed input window: drop the consumed text and append
+        the next chunk. Returns False once the stream is exhausted.
+        """
+        if self.input_stream is None:
+            return False
 
-        for s in self.output_buf:
-            print(s, file=self.output_file, end="")
+        chunk = self.input_stream.read(self.input_chunk)
+        if not chunk:
+            self.input_stream = None
+            return False
+
+        self.input_base += self.input_buf_index
+        self.input_buf = self.input_buf[self.input_buf_index:] + chunk
+        self.input_buf_index = 0
+        self.space_end = -1
+        return True
 
-        print(file=self.output_file)
+    def skip_space(self):
+        """Move past whitespace. Failed alternatives test again at the same
+        position, so the position the last skip ended at is remembered and
+        skipping from there is a no-op.
+        """
+        if self.input_buf_index == self.space_end:
+            return
+
+        while True:
+            buf = self.input_buf
+            index = self.input_buf_index
+            if index < len(buf) and buf[index].isspace():
+                index = self.input_buf_index = SPACE_RE.match(buf, index).end()
+
+            if (self.input_stream is None or
+                    len(buf) - index >= self.input_lookahead or
+                    not self.fill()):
+                break
+        self.space_end = self.input_buf_index
+
+    def scan_string(self, str_):
+        """Skip whitespace and consume str_ if the input starts with it.
+        Returns whether it did.
+        """
+        self.skip_space()
+
+        while not self.input_buf.startswith(str_, self.input_buf_index):
+            if (len(self.input_buf) - self.input_buf_index >= len(str_) or
+                    not self.fill()):
+                return False
+        self.input_buf_index += len(str_)
+        return True
+
+    def scan_token(self, pattern):
+        """Skip whitespace and consume a token matching the compiled pattern
+        into the token buffer. Returns whether a token was found.
+        """
+        self.skip_space()
+
+        match = pattern.match(self.input_buf, self.input_buf_index)
+        # a token running into the end of the window may go on in the stream
+        while self.input_stream is not None and (
+                match.end() == len(self.input_buf) if match else
+                pattern.pattern in PARTIAL and
+                regex(PARTIAL[pattern.pattern]).match(
+                    self.input_buf, self.input_buf_index)):
+            if not self.fill():
+                break
+            match = pattern.match(self.input_buf, self.input_buf_index)
+        if match:
+            self.token_buf = match.group()
+            self.input_buf_index = match.end()
+            return True
+        return False
+
+    def dump_output(self):
+        self.output.write_record(self.output_col, self.output_buf)
 
         self.output_buf = []
+        self.output_size = 0
 
     def op_TST(vm, str_):
         """After skipping initial whitespace in the input string compare it to
         the string given as argument. If the comparison is met, skip over the
         string in the input and set switch. If not met, reset switch.
         """
-        vm.skip_space()
-
-        input_ = vm.input()
-        if input_.startswith(str_):
-            vm.input_buf_index += len(str_)
-            vm.switch = True
-        else:
-            vm.switch = False
+        vm.switch = vm.scan_string(str_)
 
         vm.pc += 1
 
-    def op_ID(vm, _):
+    def op_ID(vm, pattern):
         """After skipping initial whitespace in the input string, test if it
         begins with an identifier, i.e., a letter followed by a sequence of
         letters and/or digits. If so, copy the identifier to the token buffer;
         skip over it in the input; and set switch. If not, reset switch.
         """
-        vm.skip_space()
-
-        input_ = vm.input()
-        if (match := re.match(r"^([A-Za-z]\w+)", input_)):
-            vm.token_buf = match.group(1)
-            vm.input_buf_index += len(vm.token_buf)
-            vm.switch = True
-        else:
-            vm.switch = False
+        vm.switch = vm.scan_token(pattern or regex("ID"))
 
         vm.pc += 1
 
-    def op_NUM(vm, _):
+    def op_NUM(vm, pattern):
         """After deleting initial whitespace in the input string, test if it
         begins with an number, i.e., a sequence of digits. If so, copy the
         number to the token buffer; skip over it in the input; and set switch.
         If not, reset switch.
         """
-        vm.skip_space()
-
-        input_ = vm.input()
-        if (match := re.match(r"^(\d+)", input_)):
-            vm.token_buf = match.group(1)
-            vm.input_buf_index += len(vm.token_buf)
-            vm.switch = True
-        else:
-            vm.switch = False
+        vm.switch = vm.scan_token(pattern or regex("NUM"))
 
         vm.pc += 1
 
-    def op_SR(vm, _):
+    def op_SR(vm, pattern):
         """After deleting initial whitespace in the input string, test if it
         begins with an string, i.e., a single quote followed by a sequence of
         any characters other than a single quote followed by another single
         quote. If so, copy the string (including enclosing quotes) to the token
         buffer; skip over it in the input; and set switch. If not, reset switch.
         """
-        vm.skip_space()
-
-        input_ = vm.input()
-        if (match := re.match(r"^'[^']*'", input_)):
-            vm.input_buf_index += len(match.group())
-            vm.token_buf = match.group()
-            vm.switch = True
-        else:
-            vm.switch = False
+        vm.switch = vm.scan_token(pattern or regex("SR"))
 
         vm.pc += 1
 
@@ -245,20 +2608,77 @@ class VM:
 
             3. location cell, set to the return from call location
         """
-        vm.label1_push(None)
-        vm.label2_push(None)
-        vm.pc_set_push(vm.label_to_pc[label])
+        vm.op_CLL_pc(vm.label_to_pc[label])
+
+    def op_CLL_pc(vm, pc):
+        """Linked CLL: enter the subroutine at pc.
+        """
+        vm.frames += (None, None, vm.pc)
+        vm.pc = pc
+
+    def op_CLL_memo(vm, pc):
+        """Linked CLL with memoization: replay the result of an earlier call
+        of the same rule in the same state, or record this one.
+        """
+        key = (pc, vm.input_offset, vm.switch, vm.token_buf, vm.output_col)
+        result = vm.memo.get(key)
+        if result is not None:
+            switch, offset, token_buf, fragments, output_col = result
+            vm.seek(offset)
+            vm.switch = switch
+            vm.token_buf = token_buf
+            vm.output_buf.extend(fragments)
+            vm.output_size += sum(map(len, fragments))
+            vm.output_col = output_col
+            vm.pc += 1
+            return
+
+        vm.memo_frames.append(
+            (key, vm.label_counter, vm.output_buf, len(vm.output_buf)))
+        vm.op_CLL_pc(pc)
+
+    def op_R_memo(vm, _):
+        """R recording the result of a memoized call. Calls generating labels
+        or emitting lines are not recorded, as replaying them would not
+        reproduce their output.
+        """
+        if len(vm.frames) > 3:
+            key, label_counter, output_buf, length = vm.memo_frames.pop()
+            if (vm.label_counter == label_counter and
+                    vm.output_buf is output_buf):
+                vm.memo.put(key, (vm.switch, vm.input_offset, vm.token_buf,
+                                  tuple(output_buf[length:]), vm.output_col))
+            else:
+                vm.memo.skipped += 1
+        vm.op_R(None)
+
+    def op_dispatch(vm, arg):
+        """Pseudo operation standing in for the first test of alternatives
+        (see dispatch_index): look at the next non-space character and go
+        straight to the only test that can match it, or past all of them
+        with the switch reset.
+        """
+        pc, table, other, handler, handler_arg = arg
+
+        vm.skip_space()
+        index = vm.input_buf_index
+        char = vm.input_buf[index] if index < len(vm.input_buf) else None
+        target = table.get(char, other)
+
+        if target == pc:
+            handler(handler_arg)
+        else:
+            vm.switch = False
+            vm.pc = target
 
     def op_R(vm, _):
         """Return from CLL call to location on the top of the stack and pop the
         stackframe of three cells.
         """
-        if vm.call_stack:
-            vm.label1_pop()
-            vm.label2_pop()
-            vm.pc_pop_set()
-
-            vm.pc += 1
+        frames = vm.frames
+        if len(frames) > 3:
+            vm.pc = frames[-1] + 1
+            del frames[-3:]
         else:
             vm.is_done = True
 
@@ -274,19 +2694,34 @@ class VM:
         """
         vm.pc = vm.label_to_pc[label]
 
+    def op_B_pc(vm, pc):
+        """Linked B: branch unconditionally to pc.
+        """
+        vm.pc = pc
+
     def op_BT(vm, label):
         """If the switch is true, branch to label AAA.
         """
+        vm.op_BT_pc(vm.label_to_pc[label])
+
+    def op_BT_pc(vm, pc):
+        """Linked BT: if the switch is true, branch to pc.
+        """
         if vm.switch:
-            vm.pc = vm.label_to_pc[label]
+            vm.pc = pc
         else:
             vm.pc += 1
 
     def op_BF(vm, label):
         """If the switch is false, branch to label AAA.
         """
+        vm.op_BF_pc(vm.label_to_pc[label])
+
+    def op_BF_pc(vm, pc):
+        """Linked BF: if the switch is false, branch to pc.
+        """
         if not vm.switch:
-            vm.pc = vm.label_to_pc[label]
+            vm.pc = pc
         else:
             vm.pc += 1
 
@@ -307,9 +2742,10 @@ class VM:
         vm.pc += 1
 
     def op_CI(vm, _):
-        """Copy the token buffer to the output buffer.
+        """Copy the token buffer to the output buffer. Before any token is
+        scanned that is "None", as in the original VM.
         """
-        vm.output_buf.append(vm.token_buf)
+        vm.output_buf.append(str(vm.token_buf))
 
         vm.pc += 1
 
@@ -318,10 +2754,9 @@ class VM:
         unique label and save it in the label 1 cell. In either case output the
         label.
         """
-        label = vm.label1()
-        if vm.label1() is None:
-            label = vm.label_generate()
-            vm.label1_set(label)
+        label = vm.frames[-3]
+        if label is None:
+            label = vm.frames[-3] = vm.label_generate()
         vm.output_buf.append(label)
 
         vm.pc += 1
@@ -329,10 +2764,9 @@ class VM:
     def op_GN2(vm, _):
         """Same as for GN1 except acting on the label 2 cell.
         """
-        label = vm.label2()
-        if vm.label2() is None:
-            label = vm.label_generate()
-            vm.label2_set(label)
+        label = vm.frames[-2]
+        if label is None:
+            label = vm.frames[-2] = vm.label_generate()
         vm.output_buf.append(label)
 
         vm.pc += 1
@@ -358,6 +2792,11 @@ class VM:
         """
         vm.pc = vm.label_to_pc[start_label]
 
+    def op_ADR_pc(vm, pc):
+        """Linked ADR: start at pc.
+        """
+        vm.pc = pc
+
     def op_END(vm, _):
         """Pseudo operation that specifies the end of input.
         """
@@ -365,4 +2804,4 @@ class VM:
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
@@ -0,0 +1,496 @@
+#!/usr/bin/env python3
+"""Benchmarks for the META II VM.
+
+    python metaiivm_bench.py scaling --max-size 100M
+    python metaiivm_bench.py selfcompile
+    python metaiivm_bench.py stream --size 1G
+    python metaiivm_bench.py deep --depth 1000000
+    python metaiivm_bench.py startup
+    python metaiivm_bench.py async
+    python metaiivm_bench.py suite --save baseline.json
+    python metaiivm_bench.py suite --baseline baseline.json
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from metaiivm import (ENGINES, VM, LimitError, LineBuffer, MemoTable,
+                      OutputWriter, Profiler, link, parse_code)
+
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+AEXP_MASM = os.path.join(ROOT, "tests", "aexp.masm")
+AEXP_SIMPLE = os.path.join(ROOT, "tests", "aexp_expr_simple.aexp")
+METAII_MASM = os.path.join(ROOT, "metaii.masm")
+METAII_META = os.path.join(ROOT, "metaii.meta")
+
+AEXP_STATEMENT = "v{0}:=fern+v{0}*(alpha-5)/-beta^gamma;\n"
+
+
+def parse_size(text):
+    """Parse sizes like 10K, 5M or 1G into a number of bytes."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def aexp_input(size):
+    """Generate an AEXP program of roughly size bytes."""
+    statements = []
+    total = 0
+    i = 0
+    while total < size:
+        statement = AEXP_STATEMENT.format(i)
+        statements.append(statement)
+        total += len(statement)
+        i += 1
+    return "".join(statements)
+
+
+def aexp_nested(depth):
+    """An AEXP assignment nesting parentheses depth levels deep."""
+    return "xx:=" + "(" * depth + "aa" + ")" * depth + ";\n"
+
+
+def aexp_idents(count):
+    """AEXP assignments using count distinct identifiers."""
+    names = ["id{}".format(i) for i in range(count)]
+    return "".join("{}:={}+{}*{};\n".format(names[i], names[i - 1],
+                                            names[i - 2], i)
+                   for i in range(count))
+
+
+def meta_rules(count):
+    """A META II grammar of count rules with two alternatives each."""
+    rules = ["R{0} = .ID .OUT('ID ' *) / 'k{0}' .OUT('K{0}') .,\n".format(i)
+             for i in range(count)]
+    return ".SYNTAX R0\n" + "".join(rules) + ".END\n"
+
+
+def meta_repeat(count):
+    """A META II rule made of count $ repetitions."""
+    items = " ".join("$ ('a{0}' .OUT('A{0}') / .ID)".format(i)
+                     for i in range(count))
+    return ".SYNTAX ROOT\nROOT = {} .,\n.END\n".format(items)
+
+
+def meta_nested(depth):
+    """A META II rule nesting parenthesized alternatives depth levels."""
+    return ".SYNTAX ROOT\nROOT = {}'a'{} .,\n.END\n".format(
+        "('x' / " * depth, ")" * depth)
+
+
+def prefix_grammar(count):
+    """META II code for items tried against count alternatives that all
+    start by calling the same failing rule, KW, at the same position.
+    """
+    grammar = [".SYNTAX ROOT\n",
+               "ROOT = $ ITEM .,\n",
+               "ITEM = {} / .ID .OUT('ID ' *) .,\n".format(
+                   " / ".join("P{}".format(i) for i in range(count))),
+               "KW = ('#' / '@' / '%' / '&' / '!') .ID .,\n"]
+    grammar.extend("P{0} = KW 'k{0}' .OUT('P{0}') .,\n".format(i)
+                   for i in range(count))
+    grammar.append(".END\n")
+
+    output_file = io.StringIO()
+    VM("".join(grammar), output_file).run(parse_code(open(METAII_MASM)))
+    return output_file.getvalue()
+
+
+def prefix_input(count):
+    return "".join("item{}\n".format(i) for i in range(count))
+
+
+# name -> (code file or generator, input generator, size at scale 1)
+SUITE = {
+    "aexp-statements": (AEXP_MASM, aexp_input, 100 << 10),
+    "aexp-nested": (AEXP_MASM, aexp_nested, 2000),
+    "aexp-idents": (AEXP_MASM, aexp_idents, 5000),
+    "meta-rules": (METAII_MASM, meta_rules, 1000),
+    "meta-repeat": (METAII_MASM, meta_repeat, 1000),
+    "meta-nested": (METAII_MASM, meta_nested, 1000),
+    "shared-prefix": (lambda: prefix_grammar(20), prefix_input, 2000),
+}
+
+
+def measure(code_text, input_buf, engine, repeat, memo=None, dispatch=True):
+    """Time parsing the code, running it and writing its output, and count
+    instructions and peak memory of a run, each in separate passes.
+    """
+    start = time.perf_counter()
+    code = parse_code(code_text.splitlines(keepends=True))
+    parse = time.perf_counter() - start
+    program = link(code)
+
+    run = None
+    for _ in range(repeat):
+        vm = VM(input_buf, dispatch=dispatch)
+        vm.output = sink = LineBuffer()
+        start = time.perf_counter()
+        vm.run(program, engine=engine, memo=memo)
+        elapsed = time.perf_counter() - start
+        run = elapsed if run is None else min(run, elapsed)
+        if vm.is_err:
+            raise ValueError("benchmark input failed to parse")
+
+    with open(os.devnull, "w") as output_file:
+        writer = OutputWriter(output_file, flush=1 << 16)
+        start = time.perf_counter()
+        for line in sink.lines:
+            writer.write_line(line)
+        writer.flush()
+        write = time.perf_counter() - start
+
+    profile = Profiler()
+    vm = VM(input_buf, dispatch=dispatch)
+    vm.output = LineBuffer()
+    vm.run(program, profile=profile, memo=memo)
+    instrs = sum(profile.op_counts)
+
+    tracemalloc.start()
+    vm = VM(input_buf, dispatch=dispatch)
+    vm.output = LineBuffer()
+    vm.run(program, engine=engine, memo=memo)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {"bytes": len(input_buf), "parse": parse, "run": run,
+            "write": write, "instrs": instrs, "ips": instrs / run,
+            "peak": peak}
+
+
+def bench_suite(args):
+    results = {}
+    print("{:<16} {:>9} {:>9} {:>9} {:>9} {:>10} {:>11} {:>9}".format(
+        "case", "bytes", "parse ms", "run ms", "write ms", "instrs",
+        "instrs/s", "peak KB"))
+    for name, (code, generate, size) in SUITE.items():
+        if args.cases and name not in args.cases:
+            continue
+        code_text = code() if callable(code) else open(code).read()
+        input_buf = generate(max(1, int(size * args.scale)))
+        memo = MemoTable() if args.memo else None
+        try:
+            result = measure(code_text, input_buf, args.engine, args.repeat,
+                             memo, args.dispatch)
+        except LimitError as e:
+            # like the compiled engine's recursion limit on nested inputs
+            print("{:<16} skipped: {}".format(name, e))
+            continue
+        results[name] = result
+        print("{:<16} {:>9} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>11.0f} "
+              "{:>9.0f}".format(name, result["bytes"], result["parse"] * 1e3,
+                                result["run"] * 1e3, result["write"] * 1e3,
+                                result["instrs"], result["ips"],
+                                result["peak"] / 1024))
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"engine": args.engine, "scale": args.scale,
+                       "results": results}, f, indent=2)
+
+    if args.baseline:
+        return compare(results, json.load(open(args.baseline)),
+                       args.threshold)
+
+
+def compare(results, baseline, threshold):
+    """Compare run times with a saved suite baseline, returning 1 when any
+    case got slower by more than threshold (a fraction).
+    """
+    regressed = False
+    print()
+    for name, result in results.items():
+        base = baseline["results"].get(name)
+        if base is None:
+            continue
+        change = result["run"] / base["run"] - 1
+        status = "ok"
+        if change > threshold:
+            status = "REGRESSION"
+            regressed = True
+        print("{:<16} {:>+8.1%} {}".format(name, change, status))
+    return 1 if regressed else 0
+
+
+def bench_scaling(args):
+    code = parse_code(open(AEXP_MASM))
+
+    print("{:>12} {:>10} {:>12}".format("bytes", "seconds", "ns/byte"))
+    size = args.min_size
+    while size <= args.max_size:
+        input_buf = aexp_input(size)
+        with open(os.devnull, "w") as output_file:
+            vm = VM(input_buf, output_file)
+            start = time.perf_counter()
+            vm.run(code)
+            elapsed = time.perf_counter() - start
+        print("{:>12} {:>10.3f} {:>12.1f}".format(
+            len(input_buf), elapsed, elapsed * 1e9 / len(input_buf)))
+        size *= args.factor
+
+
+def bench_stream(args):
+    code = parse_code(open(AEXP_MASM))
+
+    with tempfile.TemporaryFile("w+") as input_file:
+        chunk = aexp_input(1 << 20)
+        for _ in range(max(1, args.size // len(chunk))):
+            input_file.write(chunk)
+        size = input_file.tell()
+        input_file.seek(0)
+
+        start = time.perf_counter()
+        with open(os.devnull, "w") as output_file:
+            input_buf = input_file if args.stream else input_file.read()
+            VM(input_buf, output_file, flush=1 << 16).run(code)
+        elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("{} bytes {}: {:.1f} s, peak RSS {:.1f} MB".format(
+        size, "streamed" if args.stream else "in memory", elapsed,
+        peak / 1024))
+
+
+def bench_deep(args):
+    code = parse_code(open(AEXP_MASM))
+    input_buf = aexp_nested(args.depth)
+
+    vm = VM(input_buf, io.StringIO(), max_depth=args.max_depth)
+    start = time.perf_counter()
+    try:
+        vm.run(code, engine=args.engine)
+        result = "ok" if not vm.is_err else "failed to parse"
+    except LimitError as e:
+        result = str(e)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print("{} levels ({}): {}".format(args.depth, args.engine, result))
+    print("{:.2f} s, peak RSS {:.1f} MB, frame stack {} bytes after the "
+          "run".format(elapsed, peak / 1024, sys.getsizeof(vm.frames)))
+
+
+def bench_startup(args):
+    python = sys.executable
+    run = ["-i", AEXP_SIMPLE, "--no-cache"]
+    commands = [
+        ("python -c pass", [python, "-c", "pass"]),
+        ("python metaiivm.py", [python, os.path.join(ROOT, "metaiivm.py"),
+                                AEXP_MASM] + run),
+        ("python -m metaiivm", [python, "-m", "metaiivm", AEXP_MASM] + run),
+    ]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        mbc = os.path.join(tmp, "aexp.mbc")
+        subprocess.run([python, "-m", "metaiivm", "assemble", AEXP_MASM,
+                        "-o", mbc], cwd=ROOT, check=True)
+        commands.append(("python -m metaiivm .mbc",
+                         [python, "-m", "metaiivm", mbc] + run))
+
+        sock = os.path.join(tmp, "aexp.sock")
+        server = subprocess.Popen([python, "-m", "metaiivm", "serve", sock,
+                                   AEXP_MASM, "-j", "1"], cwd=ROOT,
+                                  stderr=subprocess.DEVNULL)
+        while not os.path.exists(sock):
+            time.sleep(0.01)
+        commands.append(("python -m metaiivm client",
+                         [python, "-m", "metaiivm", "client", sock, "aexp",
+                          "-i", AEXP_SIMPLE]))
+
+        print("{:<26} {:>8} {:>8}".format("command", "min ms", "median"))
+        for name, command in commands:
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                subprocess.run(command, cwd=ROOT, check=True,
+                               stdout=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+            print("{:<26} {:>8.1f} {:>8.1f}".format(
+                name, min(times) * 1e3, statistics.median(times) * 1e3))
+
+        server.terminate()
+        server.wait()
+
+    if args.importtime:
+        result = subprocess.run(
+            [python, "-X", "importtime", "-m", "metaiivm", AEXP_MASM] + run,
+            cwd=ROOT, check=True, stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE, universal_newlines=True)
+        # lines are "import time: self | cumulative | package"
+        imports = []
+        for line in result.stderr.splitlines()[1:]:
+            _, cumulative, package = line.split("|")
+            if not package.startswith("   "):
+                imports.append((int(cumulative), package.strip()))
+        print()
+        print("{:<26} {:>8}".format("top-level import", "ms"))
+        for cumulative, package in sorted(imports, reverse=True)[:10]:
+            print("{:<26} {:>8.1f}".format(package, cumulative / 1e3))
+
+
+def bench_async(args):
+    program = link(parse_code(open(AEXP_MASM)))
+    small = aexp_input(args.small_size)
+    large = aexp_input(args.large_size)
+
+    async def job(input_buf, slice_size):
+        vm = VM(input_buf, io.StringIO())
+        if slice_size:
+            await vm.run_async(program, slice_size=slice_size)
+        else:
+            vm.run(program)
+
+    async def load(slice_size):
+        # the large jobs start first, then a small job is due every
+        # --interval seconds; latency is from when it was due to completion,
+        # as a blocked loop also delays starting it
+        latencies = []
+
+        async def small_job(due):
+            await job(small, slice_size)
+            latencies.append(time.perf_counter() - due)
+
+        tasks = [asyncio.ensure_future(job(large, slice_size))
+                 for _ in range(args.large)]
+        start = time.perf_counter()
+        for i in range(args.small):
+            due = start + i * args.interval
+            await asyncio.sleep(max(0, due - time.perf_counter()))
+            tasks.append(asyncio.ensure_future(small_job(due)))
+        await asyncio.gather(*tasks)
+        return latencies
+
+    print("{} small jobs of {} bytes every {:g} ms, {} large jobs of {} "
+          "bytes".format(args.small, len(small), args.interval * 1e3,
+                         args.large, len(large)))
+    print("{:<16}{:>10}{:>10}{:>10}{:>10}".format(
+        "run", "p50 ms", "p99 ms", "max ms", "total s"))
+    for slice_size in [0] + args.slice:
+        start = time.perf_counter()
+        latencies = sorted(asyncio.run(load(slice_size)))
+        elapsed = time.perf_counter() - start
+        print("{:<16}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+            "blocking" if not slice_size else "slice {}".format(slice_size),
+            statistics.median(latencies) * 1e3,
+            latencies[int(len(latencies) * 0.99)] * 1e3,
+            latencies[-1] * 1e3, elapsed))
+
+
+def bench_selfcompile(args):
+    program = link(parse_code(open(METAII_MASM)))
+    meta = open(METAII_META).read()
+
+    best = None
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        for _ in range(args.number):
+            VM(meta, io.StringIO()).run(program, engine=args.engine)
+        elapsed = (time.perf_counter() - start) / args.number
+        best = elapsed if best is None else min(best, elapsed)
+    print("metaii.masm < metaii.meta ({}): {:.3f} ms per compile".format(
+        args.engine, best * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="META II VM benchmarks.")
+    subparsers = parser.add_subparsers(dest="bench", required=True)
+
+    scaling = subparsers.add_parser(
+        "scaling", help="VM.run time over growing AEXP inputs; ns/byte "
+        "should stay flat if scanning is linear")
+    scaling.add_argument("--min-size", type=parse_size, default="10K")
+    scaling.add_argument("--max-size", type=parse_size, default="10M")
+    scaling.add_argument("--factor", type=int, default=10)
+    scaling.set_defaults(func=bench_scaling)
+
+    stream = subparsers.add_parser(
+        "stream", help="peak memory of a large AEXP input, streamed or read "
+        "into memory")
+    stream.add_argument("--size", type=parse_size, default="100M")
+    stream.add_argument("--no-stream", dest="stream", action="store_false")
+    stream.set_defaults(func=bench_stream)
+
+    deep = subparsers.add_parser(
+        "deep", help="an AEXP expression nesting parentheses --depth levels "
+        "deep: time, peak memory and whether the frames are freed")
+    deep.add_argument("--depth", type=int, default=10 ** 6)
+    deep.add_argument("--max-depth", type=int,
+                      help="call depth limit, see VM(max_depth=...)")
+    deep.add_argument("--engine", choices=ENGINES, default="interp")
+    deep.set_defaults(func=bench_deep)
+
+    startup = subparsers.add_parser(
+        "startup", help="cold-start latency of the CLI compiling "
+        "tests/aexp_expr_simple.aexp")
+    startup.add_argument("--repeat", type=int, default=20)
+    startup.add_argument("--importtime", action="store_true",
+                         help="also show the slowest top-level imports, "
+                         "from python -X importtime")
+    startup.set_defaults(func=bench_startup)
+
+    async_ = subparsers.add_parser(
+        "async", help="latency of small jobs sharing an event loop with "
+        "large ones, with blocking VM.run and VM.run_async")
+    async_.add_argument("--small", type=int, default=100)
+    async_.add_argument("--small-size", type=parse_size, default="1K")
+    async_.add_argument("--large", type=int, default=2)
+    async_.add_argument("--large-size", type=parse_size, default="1M")
+    async_.add_argument("--interval", type=float, default=0.005,
+                        help="seconds between small jobs")
+    async_.add_argument("--slice", type=int, nargs="+",
+                        default=[100, 1000, 10000],
+                        help="instructions per slice to compare")
+    async_.set_defaults(func=bench_async)
+
+    selfcompile = subparsers.add_parser(
+        "selfcompile", help="compile metaii.meta with metaii.masm")
+    selfcompile.add_argument("--number", type=int, default=20)
+    selfcompile.add_argument("--repeat", type=int, default=5)
+    selfcompile.add_argument("--engine", choices=ENGINES, default="interp")
+    selfcompile.set_defaults(func=bench_selfcompile)
+
+    suite = subparsers.add_parser(
+        "suite", help="generated AEXP and META II inputs: parse, run and "
+        "write times, instructions per second and peak memory")
+    suite.add_argument("cases", nargs="*", help="cases to run: {}".format(
+        ", ".join(SUITE)))
+    suite.add_argument("--scale", type=float, default=1.0,
+                       help="input size multiplier")
+    suite.add_argument("--repeat", type=int, default=5)
+    suite.add_argument("--engine", choices=ENGINES, default="interp")
+    suite.add_argument("--memo", action="store_true",
+                       help="memoize rule calls (interp engine only)")
+    suite.add_argument("--no-dispatch", dest="dispatch", action="store_false",
+                       help="do not dispatch alternatives on their first "
+                       "character")
+    suite.add_argument("--save", help="write results to this JSON file")
+    suite.add_argument("--baseline",
+                       help="compare run times with this saved JSON file")
+    suite.add_argument("--threshold", type=float, default=0.1,
+                       help="slowdown counted as a regression "
+                       "(default: %(default)s)")
+    suite.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    if args.func is bench_suite and args.memo and args.engine == "compiled":
+        suite.error("--memo can't be used with --engine compiled")
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,22 @@
+import asyncio
 import io
+import json
+import os
+import signal
+import struct
+import subprocess
+import sys
+import time
 
 import pytest
 
-from metaiivm import VM, parse_code, Inst
+from metaiivm import (VM, parse_code, link, Inst, Program, OPCODES, ENGINES,
+                      program_source, load_program, ProgramCache,
+                      input_paths, output_path, compile_files,
+                      compile_parallel, OutputWriter, Profiler, MemoTable,
+                      dispatch_index, LimitError, assemble, load_bytecode,
+                      main, Client, grammar_paths, load_pipeline, optimize,
+                      format_code, LineCounter, Checkpoint, input_id)
 
 
 # Test the AEXP example language
@@ -18,8 +32,13 @@ from metaiivm import VM, parse_code, Inst
     # let's compile the compiler and see if it's circular
     ("metaii.masm", "metaii.meta",
      "metaii.masm"),
+
+    # the AEXP grammar in META II
+    ("metaii.masm", "tests/aexp.meta",
+     "tests/aexp.masm"),
 ])
-def test_aexp(masm_file, aexp_file, result_file):
+@pytest.mark.parametrize("engine", ENGINES)
+def test_aexp(masm_file, aexp_file, result_file, engine):
     code = parse_code(open(masm_file))
     expr = open(aexp_file).read()
     result = open(result_file).read()
@@ -27,10 +46,458 @@ def test_aexp(masm_file, aexp_file, result_file):
     output_file = io.StringIO()
     vm = VM(expr, output_file)
 
-    vm.run(code)
+    vm.run(code, engine=engine)
     assert result == output_file.getvalue()
 
 
+@pytest.mark.parametrize("masm_file, aexp_file, result_file", [
+    ("tests/aexp.masm", "tests/aexp_expr.aexp", "tests/aexp_expr.output"),
+    ("metaii.masm", "metaii.meta", "metaii.masm"),
+])
+@pytest.mark.parametrize("chunk, lookahead", [(1, 1), (3, 2), (32, 16)])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_aexp_stream(masm_file, aexp_file, result_file, chunk, lookahead,
+                     engine):
+    code = parse_code(open(masm_file))
+    result = open(result_file).read()
+
+    output_file = io.StringIO()
+    vm = VM(open(aexp_file), output_file)
+    vm.input_chunk = chunk
+    vm.input_lookahead = lookahead
+
+    vm.run(code, engine=engine)
+    assert result == output_file.getvalue()
+    # consumed input is dropped from the window
+    assert vm.input_base > 0
+    assert len(vm.input_buf) < 100
+
+
+def test_iter_run():
+    code = parse_code(open("metaii.masm"))
+    output_file = io.StringIO()
+    vm = VM(open("metaii.meta").read(), output_file)
+
+    lines = vm.iter_run(code)
+    assert next(lines) == "        ADR PROGRAM\n"
+    assert not vm.is_done
+
+    assert "        ADR PROGRAM\n" + "".join(lines) == open(
+        "metaii.masm").read()
+    assert vm.is_done
+    assert vm.output_file is output_file
+    assert output_file.getvalue() == ""
+
+
+class AsyncSource:
+    """Async input stream returning at most size characters or bytes."""
+
+    def __init__(self, data, size):
+        self.data = data
+        self.size = size
+
+    async def read(self, size):
+        await asyncio.sleep(0)
+        chunk = self.data[:min(size, self.size)]
+        self.data = self.data[len(chunk):]
+        return chunk
+
+
+@pytest.mark.parametrize("source", [
+    lambda text: text,
+    lambda text: AsyncSource(text, 7),
+    # multibyte characters split between reads
+    lambda text: AsyncSource(text.encode(), 3),
+])
+def test_aiter_run(source):
+    # non-ASCII output checks decoding of byte streams
+    meta = open("metaii.meta").read().replace("'ADR '", "'ÄDR '")
+    output_file = io.StringIO()
+    VM(meta, output_file).run(parse_code(open("metaii.masm")))
+
+    async def run():
+        vm = VM(source(meta))
+        vm.input_chunk = 16
+        vm.input_lookahead = 4
+        return [line async for line in vm.aiter_run(
+            parse_code(open("metaii.masm")), slice_size=10)]
+
+    lines = asyncio.run(run())
+    assert "".join(lines) == output_file.getvalue()
+    assert "        CL 'ÄDR '\n" in lines
+
+
+def test_run_async_invalid():
+    code = parse_code(open("tests/aexp.masm"))
+
+    async def run():
+        async for _ in VM("fern:=5+6;").aiter_run(code, slice_size=0):
+            pass
+
+    with pytest.raises(ValueError):
+        asyncio.run(run())
+    with pytest.raises(ValueError):
+        asyncio.run(VM("fern:=5+6;", io.StringIO()).run_async(
+            code, slice_size=0))
+
+
+def test_run_async():
+    code = link(parse_code(open("tests/aexp.masm")))
+    inputs = ["".join("v{0}:=v{0}+1;".format(i) for i in range(500)),
+              "fern:=5+6;", "fern:=5+;"]
+    finished = []
+
+    class Writer:
+        def __init__(self):
+            self.data = b""
+
+        def write(self, data):
+            self.data += data
+
+        async def drain(self):
+            pass
+
+    async def run(input_buf):
+        writer = Writer()
+        vm = VM(input_buf)
+        await vm.run_async(code, writer, slice_size=10)
+        finished.append(input_buf)
+        return writer.data.decode(), vm.is_err
+
+    async def run_all():
+        return await asyncio.gather(*map(run, inputs))
+
+    results = asyncio.run(run_all())
+    for input_buf, (output, is_err) in zip(inputs, results):
+        output_file = io.StringIO()
+        vm = VM(input_buf, output_file)
+        vm.run(code)
+        assert (output, is_err) == (output_file.getvalue(), vm.is_err)
+    # the short runs did not wait for the long one
+    assert finished[-1] == inputs[0]
+
+
+class Killed(Exception):
+    pass
+
+
+class KilledCheckpoint(Checkpoint):
+    """Checkpoint stopping the run after saving it twice."""
+
+    saves = 0
+
+    def save(self, vm):
+        super().save(vm)
+        self.saves += 1
+        if self.saves == 2:
+            raise Killed
+
+
+def killed_run(path, input_buf, input_id=None):
+    output_file = io.StringIO()
+    vm = VM(input_buf, output_file)
+    with pytest.raises(Killed):
+        vm.run(parse_code(open("metaii.masm")),
+               checkpoint=KilledCheckpoint(path, every=500,
+                                           input_id=input_id))
+    return output_file.getvalue()
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_checkpoint(tmp_path, stream):
+    path = str(tmp_path / "checkpoint")
+    meta = open("metaii.meta").read()
+    output = killed_run(path, open("metaii.meta") if stream else meta)
+
+    snapshot, position = Checkpoint(path).load()
+    assert 0 < position <= len(output)
+
+    # resume, dropping the output written after the checkpoint
+    output_file = io.StringIO(output)
+    output_file.seek(position)
+    output_file.truncate()
+    vm = VM(open("metaii.meta") if stream else meta, output_file)
+    vm.input_chunk = 32
+    vm.input_lookahead = 16
+    vm.restore(snapshot, parse_code(open("metaii.masm")))
+    vm.run(parse_code(open("metaii.masm")))
+    assert output_file.getvalue() == open("metaii.masm").read()
+    if stream:
+        assert len(vm.input_buf) < 100
+
+
+def test_checkpoint_main(tmp_path, capsys):
+    path = str(tmp_path / "checkpoint")
+    killed_run(path, open("metaii.meta").read(), input_id("metaii.meta"))
+    _, position = Checkpoint(path, input_id=input_id("metaii.meta")).load()
+
+    main(["--checkpoint", path, "--no-cache", "metaii.masm",
+          "-i", "metaii.meta"])
+    # stdout can't be truncated here, so output goes on from the checkpoint
+    assert capsys.readouterr().out == open("metaii.masm").read()[position:]
+    assert not os.path.exists(path)
+
+
+def test_checkpoint_other_input(tmp_path, capsys):
+    path = str(tmp_path / "checkpoint")
+    killed_run(path, open("metaii.meta").read(), input_id("metaii.meta"))
+    input_path = tmp_path / "metaii.meta"
+    input_path.write_text(open("metaii.meta").read() + " ")
+
+    assert main(["--checkpoint", path, "--no-cache", "metaii.masm",
+                 "-i", str(input_path)]) == 1
+    assert "of another input" in capsys.readouterr().err
+    assert os.path.exists(path)
+
+
+@pytest.mark.parametrize("flags", [
+    ["--checkpoint-every", "0"],
+    ["--memo"],
+    ["--trace"],
+    ["--profile"],
+    ["-i", "tests/aexp_add.aexp"],
+])
+def test_checkpoint_main_invalid(tmp_path, flags):
+    with pytest.raises(SystemExit):
+        main(["--checkpoint", str(tmp_path / "checkpoint"), "metaii.masm",
+              "-i", "metaii.meta"] + flags)
+    assert not os.path.exists(str(tmp_path / "checkpoint"))
+    with pytest.raises(ValueError):
+        Checkpoint(str(tmp_path / "checkpoint"), every=0)
+
+
+@pytest.mark.parametrize("argv", [
+    ["metaii.masm", "--trace"],
+    ["metaii.masm", "--profile"],
+    ["metaii.masm", "--memo"],
+    ["metaii.masm", "--max-depth", "100"],
+    ["metaii.masm", "--max-output", "1K"],
+    ["metaii.masm", "--checkpoint", "checkpoint"],
+    ["serve", "socket", "metaii.masm", "--max-depth", "100"],
+    ["serve", "socket", "metaii.masm", "--max-output", "1K"],
+])
+def test_compiled_main_invalid(capsys, argv):
+    with pytest.raises(SystemExit):
+        main(argv + ["--engine", "compiled"])
+    assert "--engine compiled can't be used" in capsys.readouterr().err
+
+
+def test_snapshot_invalid():
+    vm = VM(open("metaii.meta").read(), io.StringIO())
+    with pytest.raises(ValueError):
+        vm.snapshot()
+    vm.run(parse_code(open("metaii.masm")))
+    snapshot = vm.snapshot()
+
+    with pytest.raises(ValueError, match="other code"):
+        VM("").restore(snapshot, parse_code(open("tests/aexp.masm")))
+    with pytest.raises(ValueError, match="Corrupt"):
+        VM("").restore(snapshot[:-3], parse_code(open("metaii.masm")))
+    with pytest.raises(ValueError):
+        VM("", io.StringIO()).run(parse_code(open("metaii.masm")),
+                                  engine="compiled",
+                                  checkpoint=Checkpoint("unused"))
+
+
+def test_fork():
+    code = link(parse_code(open("metaii.masm")))
+    result = open("metaii.masm").read()
+    vm = VM(open("metaii.meta").read(), io.StringIO())
+    lines = vm.iter_run(code)
+    head = "".join(next(lines) for _ in range(50))
+
+    forks = [vm.fork(io.StringIO()) for _ in range(2)]
+    for fork in forks:
+        fork.run(code)
+        assert head + fork.output_file.getvalue() == result
+    assert head + "".join(lines) == result
+
+
+def test_profile():
+    code = parse_code(open("tests/aexp.masm"))
+    expr = open("tests/aexp_expr.aexp").read()
+
+    output_file = io.StringIO()
+    profile = Profiler()
+    VM(expr, output_file).run(code, profile=profile)
+    assert output_file.getvalue() == open("tests/aexp_expr.output").read()
+
+    stats = json.loads(json.dumps(profile.as_dict()))
+    rules = stats["rules"]
+    assert rules["AS"]["calls"] == 4
+    assert rules["AS"]["chars"] == len(expr)
+    assert rules["(top)"]["calls"] == 1
+    assert rules["(top)"]["instrs"] == sum(stats["ops"].values())
+    assert rules["(top)"]["instrs"] == sum(
+        rule["own_instrs"] for rule in rules.values())
+    assert stats["ops"]["CLL"] == sum(
+        rule["calls"] for name, rule in rules.items() if name != "(top)")
+
+    table = profile.table()
+    assert table.startswith("rule")
+    assert "\nEX5 " in table
+
+
+@pytest.mark.parametrize("masm_file, aexp_file, result_file", [
+    ("tests/aexp.masm", "tests/aexp_expr.aexp", "tests/aexp_expr.output"),
+    ("metaii.masm", "metaii.meta", "metaii.masm"),
+])
+def test_memo(masm_file, aexp_file, result_file):
+    code = parse_code(open(masm_file))
+
+    output_file = io.StringIO()
+    memo = MemoTable()
+    VM(open(aexp_file).read(), output_file).run(code, memo=memo)
+    assert output_file.getvalue() == open(result_file).read()
+    assert memo.misses > 0
+
+
+def test_memo_replay():
+    code = [
+        Inst(op="ADR", arg="START", labels=[]),
+        Inst(op="CL", arg="x", labels=["FRAG"]),
+        Inst(op="LB", arg=None, labels=[]),
+        Inst(op="R", arg=None, labels=[]),
+        # labels are not replayed, so calls generating them are not memoized
+        Inst(op="GN1", arg=None, labels=["GEN"]),
+        Inst(op="R", arg=None, labels=[]),
+        Inst(op="CLL", arg="FRAG", labels=["START"]),
+        Inst(op="CLL", arg="FRAG", labels=[]),
+        Inst(op="CLL", arg="GEN", labels=[]),
+        Inst(op="CLL", arg="GEN", labels=[]),
+        Inst(op="OUT", arg=None, labels=[]),
+        Inst(op="CLL", arg="FRAG", labels=[]),
+        Inst(op="OUT", arg=None, labels=[]),
+        Inst(op="END", arg=None, labels=[]),
+    ]
+
+    output_file = io.StringIO()
+    memo = MemoTable()
+    VM("", output_file).run(code, memo=memo)
+    assert output_file.getvalue() == "xxL1L2\nx\n"
+    # the second FRAG call replays the first, the last one starts at a
+    # different output column
+    assert (memo.hits, memo.misses, memo.skipped) == (1, 4, 2)
+
+
+def test_memo_evict():
+    memo = MemoTable(max_entries=2)
+    for key in ("a", "b", "c"):
+        memo.put(key, key)
+    assert memo.get("a") is None
+    assert memo.get("b") == "b"
+    memo.put("d", "d")
+    assert list(memo.entries) == ["b", "d"]
+    assert memo.evicted == 2
+
+
+@pytest.mark.parametrize("masm_file, aexp_file, result_file, skips", [
+    ("tests/aexp.masm", "tests/aexp_expr.aexp", "tests/aexp_expr.output",
+     True),
+    # no rule with alternatives to skip
+    ("tests/aexp_add.masm", "tests/aexp_add.aexp", "tests/aexp_add.output",
+     False),
+    ("metaii.masm", "metaii.meta", "metaii.masm", True),
+])
+def test_dispatch(masm_file, aexp_file, result_file, skips):
+    code = parse_code(open(masm_file))
+
+    executed = {}
+    for dispatch in [True, False]:
+        output_file = io.StringIO()
+        profile = Profiler()
+        vm = VM(open(aexp_file).read(), output_file, dispatch=dispatch)
+        vm.run(code, profile=profile)
+        assert output_file.getvalue() == open(result_file).read()
+        executed[dispatch] = sum(profile.op_counts)
+    # alternatives that can't match the next character are skipped
+    assert (executed[True] < executed[False]) == skips
+    assert executed[True] <= executed[False]
+
+
+def test_trace(capsys):
+    vm = VM("res:=1+2;", io.StringIO())
+    vm.run(parse_code(open("tests/aexp.masm")), trace=True)
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[0].startswith("    0 ADR  AEXP , input_buf='res:=1+2;'")
+    assert lines[1].startswith("    1 CLL  AS , ")
+    assert lines[4].startswith("   10 CL   'address ' , ")
+
+
+def test_dispatch_index():
+    program = link(parse_code(open("tests/aexp.masm")))
+    # EX5 = .ID .OUT('load ' *) / .NUM .OUT('literal ' *) /
+    #       '(' EX1 ')' .,
+    pc = program.label_to_pc["EX5"]
+    table, other = dispatch_index(program)[pc]
+    assert table["a"] == pc
+    assert table["1"] > pc
+    assert table["("] > table["1"]
+    # nothing matches at the end of input, so EX5 returns
+    assert table[None] == program.label_to_pc["L28"]
+
+
+NESTED_AEXP = "xx:=" + "(" * 100 + "aa" + ")" * 100 + ";\n"
+
+
+@pytest.mark.parametrize("limits, kind, rule", [
+    ({"max_depth": 50}, "depth", "EX5"),
+    ({"max_output": 5}, "output", "AS"),
+])
+def test_limits(limits, kind, rule):
+    code = parse_code(open("tests/aexp.masm"))
+    with pytest.raises(LimitError) as e:
+        VM(NESTED_AEXP, io.StringIO(), **limits).run(code)
+    assert e.value.kind == kind
+    assert e.value.rule == rule
+    assert e.value.depth <= 50
+    assert 0 < e.value.offset < len(NESTED_AEXP)
+
+    result, = VM("", **limits).run_many(code, [NESTED_AEXP])
+    assert not result.ok
+    assert result.error == str(e.value)
+
+
+def test_limits_unreached():
+    code = parse_code(open("tests/aexp.masm"))
+    output_file = io.StringIO()
+    vm = VM(NESTED_AEXP, output_file, max_depth=1000, max_output=100)
+    vm.run(code)
+    assert output_file.getvalue().endswith("store\n")
+    # only the top level frame is left
+    assert len(vm.frames) == 3
+
+
+def test_limits_compiled():
+    code = parse_code(open("tests/aexp.masm"))
+    with pytest.raises(ValueError):
+        VM(NESTED_AEXP, max_depth=10).run(code, engine="compiled")
+
+    input_buf = "xx:=" + "(" * 10000 + "aa" + ")" * 10000 + ";\n"
+    with pytest.raises(LimitError) as e:
+        VM(input_buf, io.StringIO()).run(code, engine="compiled")
+    assert e.value.kind == "recursion"
+
+
+def test_profile_compiled():
+    with pytest.raises(ValueError):
+        VM("").run([Inst(op="END", arg=None, labels=[])], engine="compiled",
+                   profile=Profiler())
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_aexp_error(engine, capsys):
+    code = parse_code(open("tests/aexp.masm"))
+
+    output_file = io.StringIO()
+    vm = VM("fern:=5+;", output_file)
+
+    vm.run(code, engine=engine)
+    assert vm.is_err
+    assert output_file.getvalue() == "        address fern\n        literal 5\n"
+    assert "Failed to parse input!" in capsys.readouterr().err
+
+
 #
 # Test executing programs
 
@@ -113,14 +580,501 @@ def test_aexp(masm_file, aexp_file, result_file):
          Inst(op="R", arg=None, labels=[]),
      ], "        functionafter\n"),
 ])
-def test_run(input_buf, code, output):
+@pytest.mark.parametrize("engine", ENGINES)
+def test_run(input_buf, code, output, engine):
     output_file = io.StringIO()
     vm = VM(input_buf, output_file)
-    vm.run(code)
+    vm.run(code, engine=engine)
 
     assert output == output_file.getvalue()
 
 
+def test_run_linked():
+    program = link(parse_code(open("tests/aexp.masm")))
+    expr = open("tests/aexp_expr.aexp").read()
+    result = open("tests/aexp_expr.output").read()
+
+    # a linked program can be reused across VMs
+    for _ in range(2):
+        output_file = io.StringIO()
+        VM(expr, output_file).run(program)
+        assert result == output_file.getvalue()
+
+
+def test_program_source():
+    program = link(parse_code(open("metaii.masm")))
+    source = program_source(program)
+
+    # one function per called rule, plus the code at pc 0
+    assert "    def r0(sw):" in source
+    assert "  # EX1\n" in source
+    compile(source, "<test>", "exec")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_run_many(engine):
+    code = parse_code(open("tests/aexp.masm"))
+    inputs = [open("tests/aexp_expr.aexp").read(), "fern:=;",
+              open("tests/aexp_add.aexp").read()]
+
+    output_file = io.StringIO()
+    vm = VM("", output_file)
+    results = list(vm.run_many(code, inputs, engine=engine))
+
+    assert [result.ok for result in results] == [True, False, True]
+    assert results[0].output == open("tests/aexp_expr.output").read()
+    assert results[1].output == "        address fern\n"
+    assert results[2].output == open("tests/aexp_add.output").read()
+    assert all(result.seconds >= 0 for result in results)
+    assert vm.output_file is output_file
+    assert output_file.getvalue() == ""
+
+
+def test_compile_parallel(tmp_path):
+    bad = tmp_path / "bad.aexp"
+    bad.write_text("fern:=;")
+    undecodable = tmp_path / "undecodable.aexp"
+    undecodable.write_bytes(b"fern:=\xff;")
+    paths = ["tests/aexp_expr.aexp", str(bad), str(tmp_path / "missing"),
+             str(undecodable), "tests/aexp_add.aexp",
+             "tests/aexp_expr_simple.aexp"] * 3
+
+    serial = list(compile_files(parse_code(open("tests/aexp.masm")), paths))
+    parallel = list(compile_parallel(parse_code(open("tests/aexp.masm")),
+                                     paths, jobs=2, chunksize=2))
+
+    assert [result.ok for result in serial] == [True, False, False, False,
+                                                True, True] * 3
+    assert serial[0].output == open("tests/aexp_expr.output").read()
+    assert serial[1].error == "Failed to parse input!"
+    assert serial[2].error == "No such file or directory"
+    assert "can't decode byte 0xff" in serial[3].error
+    assert ([result._replace(seconds=None) for result in serial] ==
+            [result._replace(seconds=None) for result in parallel])
+
+
+def test_grammar_paths():
+    assert grammar_paths(["metaii.masm", "tests/aexp.masm", "x=a/b.mbc"]) == {
+        "metaii": "metaii.masm", "aexp": "tests/aexp.masm", "x": "a/b.mbc"}
+
+
+def test_serve(tmp_path, capsys):
+    path = str(tmp_path / "metaii.sock")
+    server = subprocess.Popen([sys.executable, "-m", "metaiivm", "serve",
+                               path, "metaii.masm", "tests/aexp.masm",
+                               "-j", "1"])
+    try:
+        for _ in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(0.1)
+
+        with Client(path) as client:
+            result = client.compile("metaii", open("metaii.meta").read())
+            assert result.ok
+            assert result.output == open("metaii.masm").read()
+
+            result = client.compile("aexp", "xx:=;")
+            assert (result.ok, result.error) == (False,
+                                                 "Failed to parse input!")
+
+            result = client.compile("nope", "")
+            assert (result.ok, result.error) == (False,
+                                                 "Unknown grammar: nope")
+
+            # a bad request gets an error and the connection stays usable
+            result = client.compile([1], "x")
+            assert (result.ok, result.error) == (
+                False, "Bad request: grammar is not a string")
+            assert client.compile("aexp", "xx:=1;").ok
+
+        input_path = tmp_path / "expr.aexp"
+        input_path.write_text(open("tests/aexp_expr.aexp").read())
+        assert main(["client", path, "aexp", "-i", str(input_path)]) == 0
+        assert capsys.readouterr().out == open(
+            "tests/aexp_expr.output").read()
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait(10)
+    assert not os.path.exists(path)
+
+
+def test_input_paths_unmatched(capsys):
+    with pytest.raises(ValueError):
+        input_paths(["tests/nomatch*.aexp"])
+    assert main(["tests/aexp.masm", "-i", "tests/nomatch*.aexp",
+                 "-i", "tests/aexp_add.aexp", "-i", "tests/none?.aexp"]) == 1
+    assert capsys.readouterr().err == (
+        "tests/nomatch*.aexp: no files match\n"
+        "tests/none?.aexp: no files match\n")
+
+
+def test_input_missing(capsys):
+    assert main(["tests/aexp.masm", "-i", "tests/nope.aexp"]) == 1
+    assert capsys.readouterr().err == (
+        "tests/nope.aexp: No such file or directory\n")
+
+
+def test_batch_out_dir(tmp_path, capsys):
+    out_dir = str(tmp_path / "out" / "aexp")
+    assert main(["tests/aexp.masm", "-i", "tests/aexp_expr.aexp",
+                 "-i", "tests/aexp_add.aexp", "--out-dir", out_dir]) == 0
+    assert open(os.path.join(out_dir, "aexp_expr.out")).read() == open(
+        "tests/aexp_expr.output").read()
+    assert os.path.exists(os.path.join(out_dir, "aexp_add.out"))
+
+    other = tmp_path / "aexp_add.aexp"
+    other.write_text("fern:=5+6;")
+    assert main(["tests/aexp.masm", "-i", "tests/aexp_add.aexp",
+                 "-i", str(other), "--out-dir", str(tmp_path / "o2")]) == 1
+    assert capsys.readouterr().err.endswith(
+        "{}: output {} also written for tests/aexp_add.aexp\n".format(
+            other, os.path.join(str(tmp_path / "o2"), "aexp_add.out")))
+    assert not os.path.exists(str(tmp_path / "o2"))
+
+
+@pytest.mark.parametrize("flags", [
+    ["--trace"],
+    ["--profile"],
+    ["--memo"],
+    ["--count"],
+    ["--stream"],
+    ["--output-encoding", "utf-16"],
+])
+def test_batch_invalid(tmp_path, flags):
+    out_dir = str(tmp_path / "out")
+    with pytest.raises(SystemExit):
+        main(["tests/aexp.masm", "-i", "tests/aexp_expr.aexp",
+              "-i", "tests/aexp_add.aexp", "--out-dir", out_dir] + flags)
+    assert not os.path.exists(out_dir)
+
+
+def test_input_paths():
+    manifest = io.StringIO("a.src\n\n  b.src\n")
+    paths = input_paths(["tests/aexp_*.aexp", "x.src"], manifest)
+
+    assert paths == ["tests/aexp_add.aexp", "tests/aexp_expr.aexp",
+                     "tests/aexp_expr_simple.aexp", "x.src", "a.src", "b.src"]
+
+
+@pytest.mark.parametrize("path, out_dir, out_ext, want", [
+    ("tests/a.aexp", None, ".out", "tests/a.out"),
+    ("tests/a.aexp", "build", ".masm", "build/a.masm"),
+    ("a", None, ".out", "a.out"),
+])
+def test_output_path(path, out_dir, out_ext, want):
+    assert output_path(path, out_dir, out_ext) == want
+
+
+#
+# Test linking
+
+def test_link():
+    program = link([
+        Inst(op="ADR", arg="START", labels=[]),
+        Inst(op="CL", arg="before", labels=[]),
+        Inst(op="CLL", arg="START", labels=["START", "OTHER"]),
+        Inst(op="END", arg=None, labels=[]),
+    ])
+
+    assert isinstance(program, Program)
+    assert list(program.ops) == [OPCODES["ADR"], OPCODES["CL"],
+                                 OPCODES["CLL"], OPCODES["END"]]
+    assert program.args == [2, "before", 2, None]
+    assert program.label_to_pc == {"START": 2, "OTHER": 2}
+    assert link(program) is program
+
+
+def test_program_insts():
+    code = parse_code(open("metaii.masm"))
+    program = link(code)
+    insts = program.insts()
+    assert [i.op for i in insts] == [i.op for i in code]
+    assert [sorted(i.labels) for i in insts] == [sorted(i.labels)
+                                                  for i in code]
+    # labels of the same pc are interchangeable as arguments
+    assert link(insts).args == program.args
+
+    output_file = io.StringIO()
+    VM(open("metaii.meta").read(), output_file).run(insts)
+    assert output_file.getvalue() == open("metaii.masm").read()
+
+
+# Optimized code must give the same output as the original
+@pytest.mark.parametrize("masm_file, aexp_file", [
+    ("tests/aexp.masm", "tests/aexp_expr.aexp"),
+    ("tests/aexp.masm", "tests/aexp_expr_simple.aexp"),
+    ("tests/aexp_add.masm", "tests/aexp_add.aexp"),
+    ("metaii.masm", "metaii.meta"),
+    ("metaii.masm", "tests/aexp.meta"),
+])
+@pytest.mark.parametrize("engine", ENGINES)
+def test_optimize(masm_file, aexp_file, engine):
+    code = parse_code(open(masm_file))
+    optimized, report = optimize(code)
+    assert len(optimized) < len(code)
+    assert report["BE removed"] > 0
+    assert parse_code(io.StringIO(format_code(optimized))) == optimized
+    assert optimize(optimized)[0] == optimized
+
+    outputs = []
+    for c in (code, optimized):
+        output_file = io.StringIO()
+        VM(open(aexp_file).read(), output_file).run(c, engine=engine)
+        outputs.append(output_file.getvalue())
+    assert outputs[0] == outputs[1]
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_optimize_error(engine):
+    code = parse_code(open("tests/aexp.masm"))
+
+    output_file = io.StringIO()
+    vm = VM("fern:=5+;", output_file)
+    vm.run(optimize(code)[0], engine=engine)
+    assert vm.is_err
+    assert output_file.getvalue() == "        address fern\n        literal 5\n"
+
+
+@pytest.mark.parametrize("code, want", [
+    # BE after SET always passes, then nothing reads the switch SET sets
+    ("""        TST 'a'
+        SET
+        BE
+        TST 'b'
+        R
+""", """        TST 'a'
+        TST 'b'
+        R
+"""),
+    # BF to BT is threaded past it, then the BT is known to branch, to R
+    ("""        TST 'a'
+        BF L1
+        CL 'a'
+        OUT
+L1
+L2
+        BT L3
+        TST 'b'
+L3
+        R
+""", """        TST 'a'
+        BF L4
+        CL 'a'
+        OUT
+        R
+L4
+        TST 'b'
+        R
+"""),
+    # R returns the switch
+    ("""        ID
+        BT L1
+        SET
+L1
+        R
+""", """        ID
+        BT L1
+        SET
+L1
+        R
+"""),
+])
+def test_optimize_code(code, want):
+    assert format_code(optimize(parse_code(io.StringIO(code)))[0]) == want
+
+
+def test_optimize_main(tmp_path, capsys):
+    path = str(tmp_path / "metaii.masm")
+    assert main(["optimize", "metaii.masm", "-o", path]) == 0
+    assert "metaii.masm: 165 -> " in capsys.readouterr().err
+
+    main(["--optimize", "--no-cache", path, "-i", "metaii.meta"])
+    assert capsys.readouterr().out == open("metaii.masm").read()
+
+
+@pytest.mark.parametrize("code", [
+    [Inst(op="NOPE", arg=None, labels=[])],
+    [Inst(op="B", arg="MISSING", labels=[])],
+])
+def test_link_invalid(code):
+    with pytest.raises(ValueError):
+        link(code)
+
+
+#
+# Test the linked code cache
+
+def test_lazy_imports():
+    # a fresh interpreter, as pytest itself imports most of these
+    modules = subprocess.check_output([sys.executable, "-c", """if True:
+        import sys, metaiivm
+        print(sorted(set(sys.modules) & {"argparse", "concurrent.futures",
+                                         "glob", "hashlib", "json",
+                                         "tempfile"}), metaiivm._regexes)
+        """], universal_newlines=True)
+    assert modules == "[] {}\n"
+
+
+@pytest.mark.parametrize("masm_file", ["metaii.masm", "tests/aexp.masm"])
+def test_bytecode(masm_file):
+    program = link(parse_code(open(masm_file)))
+    loaded = load_bytecode(assemble(program))
+
+    assert loaded.ops == program.ops
+    assert loaded.args == program.args
+    assert loaded.label_to_pc == program.label_to_pc
+
+
+def corrupt_last_op(arg, op="CLL"):
+    """aexp bytecode with its last op replaced by op with the raw arg."""
+    data = bytearray(assemble(parse_code(open("tests/aexp.masm"))))
+    _, _, n_ops, n_strings, n_labels = struct.unpack_from("<4sIIII", data)
+    offset = 20 + 4 * n_strings
+    offset += 4 + struct.unpack_from("<I", data, offset)[0] + n_ops
+    data[offset - 1] = OPCODES[op]
+    data[offset + 4 * n_ops - 4:offset + 4 * n_ops] = arg
+    return bytes(data)
+
+
+@pytest.mark.parametrize("data", [
+    b"",
+    b"MIIB\x02\x00\x00\x00" + bytes(12),
+    assemble(parse_code(open("tests/aexp.masm")))[:-1],
+    assemble(parse_code(open("tests/aexp.masm"))) + b"\x00",
+    # a label's string index, then its pc, past the end
+    assemble(parse_code(open("tests/aexp.masm")))[:-8] + b"\xff" * 4 +
+    bytes(4),
+    assemble(parse_code(open("tests/aexp.masm")))[:-4] + b"\xff" * 4,
+    # the last op made a CLL past the end
+    corrupt_last_op(b"\xff" * 4),
+    # the last op made a CL of a string past the end
+    corrupt_last_op(b"\xff" * 4, "CL"),
+])
+def test_bytecode_corrupt(data):
+    with pytest.raises(ValueError):
+        load_bytecode(data)
+
+
+def test_assemble_main(tmp_path):
+    mbc = str(tmp_path / "metaii.mbc")
+    assert main(["assemble", "metaii.masm", "-o", mbc]) == 0
+
+    output_file = io.StringIO()
+    VM(open("metaii.meta").read(), output_file).run(open(mbc, "rb").read())
+    assert output_file.getvalue() == open("metaii.masm").read()
+
+    assert load_program(open(mbc, "rb").read()).ops == link(
+        parse_code(open("metaii.masm"))).ops
+
+
+@pytest.mark.parametrize("command", ["assemble", "optimize"])
+def test_bad_code_main(tmp_path, capsys, command):
+    assert main([command, "tests/aexp_expr.output",
+                 "-o", str(tmp_path / "out")]) == 1
+    assert capsys.readouterr().err == (
+        "tests/aexp_expr.output: line 2: not an instruction: 'literal 5'\n")
+
+
+def test_parse_code_invalid():
+    with pytest.raises(ValueError, match="line 3: "):
+        parse_code(io.StringIO("        ID\n\n        1D\n"))
+
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_pipeline(tmp_path, use_cache):
+    cache = ProgramCache(str(tmp_path)) if use_cache else None
+    sources = [open("metaii.meta").read(), open("tests/aexp.meta").read()]
+    for _ in range(2):
+        program = load_pipeline(open("metaii.masm").read(), sources, cache)
+        assert program.ops == link(parse_code(open("tests/aexp.masm"))).ops
+
+        output_file = io.StringIO()
+        VM(open("tests/aexp_expr.aexp").read(), output_file).run(program)
+        assert output_file.getvalue() == open("tests/aexp_expr.output").read()
+    if use_cache:
+        # the code and both generated programs
+        assert len(os.listdir(str(tmp_path))) == 3
+
+
+def test_pipeline_error(capsys):
+    code = open("metaii.masm").read()
+    with pytest.raises(ValueError):
+        load_pipeline(code, [".SYNTAX AA AA = .,"])
+    with pytest.raises(ValueError):
+        load_pipeline(code, ["not a grammar"])
+    # the generated code is not META II code
+    with pytest.raises(ValueError, match="source 1 generated bad code"):
+        load_pipeline(open("tests/aexp.masm").read(),
+                      [open("tests/aexp_expr.aexp").read()])
+
+
+def test_pipeline_main(capsys):
+    assert main(["pipeline", "metaii.masm", "metaii.meta", "tests/aexp.meta",
+                 "--no-cache", "--", "tests/aexp_expr.aexp"]) == 0
+    assert capsys.readouterr().out == open("tests/aexp_expr.output").read()
+
+
+@pytest.mark.parametrize("argv, error", [
+    (["pipeline", "metaii.masm", "nope.meta"],
+     "nope.meta: No such file or directory\n"),
+    (["pipeline", "metaii.masm", "tests/aexp.meta", "--no-cache", "--",
+      "nope.aexp"], "nope.aexp: No such file or directory\n"),
+    (["serve", "metaiivm.sock", "nope.masm"],
+     "nope.masm: No such file or directory\n"),
+    (["serve", "metaiivm.sock", "tests/aexp_expr.output"],
+     "tests/aexp_expr.output: line 2: not an instruction: 'literal 5'\n"),
+])
+def test_main_load_errors(capsys, argv, error):
+    assert main(argv) == 1
+    assert capsys.readouterr().err == error
+    assert not os.path.exists("metaiivm.sock")
+
+
+def test_cache(tmp_path):
+    source = open("tests/aexp.masm").read()
+    cache = ProgramCache(str(tmp_path))
+
+    assert cache.load(source) is None
+    program = load_program(source, cache)
+    assert os.listdir(str(tmp_path)) == [os.path.basename(
+        cache.entry_path(source))]
+
+    cached = cache.load(source)
+    assert cached.ops == program.ops
+    assert cached.args == program.args
+    assert cached.label_to_pc == program.label_to_pc
+    assert cache.load(source + "\n        END\n") is None
+
+
+def test_cache_corrupt(tmp_path):
+    source = open("tests/aexp.masm").read()
+    cache = ProgramCache(str(tmp_path))
+    with open(cache.entry_path(source), "wb") as f:
+        f.write(b"garbage")
+
+    assert cache.load(source) is None
+    assert load_program(source, cache).ops == link(
+        parse_code(open("tests/aexp.masm"))).ops
+    assert cache.load(source) is not None
+
+
+def test_cache_evict(tmp_path):
+    sources = [open(path).read()
+               for path in ("tests/aexp.masm", "tests/aexp_add.masm",
+                            "metaii.masm")]
+    cache = ProgramCache(str(tmp_path))
+    for i, source in enumerate(sources):
+        load_program(source, cache)
+        os.utime(cache.entry_path(source), (i, i))
+
+    # the newest entry is evicted last
+    cache.max_bytes = os.path.getsize(cache.entry_path(sources[-1]))
+    cache.evict()
+    assert os.listdir(str(tmp_path)) == [os.path.basename(
+        cache.entry_path(sources[-1]))]
+
+
 #
 # Test reading opcodes from a file
 
@@ -157,6 +1111,21 @@ def test_parse_file(input_, instrs_want):
 #
 # Test ops
 
+@pytest.mark.parametrize("stream", [False, True])
+def test_skip_space(stream):
+    input_buf = " \t\n\u3000a  \n b"
+    vm = VM(io.StringIO(input_buf) if stream else input_buf)
+    vm.input_chunk = vm.input_lookahead = 2
+    vm.skip_space()
+    assert vm.input_offset == 4
+    vm.skip_space()
+    assert vm.input_offset == 4
+    assert vm.scan_string("a")
+    vm.skip_space()
+    assert vm.input_offset == 9
+    assert vm.input() == "b"
+
+
 @pytest.mark.parametrize("vm_buf_begin, op_arg, vm_buf_end, is_success", [
     ("true", "true", "", True),
     ("   true1", "true", "1", True),
@@ -383,6 +1352,20 @@ def test_op_CI():
     assert vm.output_buf[-1] == "test"
 
 
+@pytest.mark.parametrize("engine", ENGINES)
+def test_CI_no_token(engine):
+    code = [Inst(op="CI", arg=None, labels=[]),
+            Inst(op="OUT", arg=None, labels=[]),
+            Inst(op="END", arg=None, labels=[])]
+    output_file = io.StringIO()
+    VM("", output_file).run(code, engine=engine)
+    assert output_file.getvalue() == "        None\n"
+
+    counter = LineCounter()
+    VM("", counter, max_output=100).run(code)
+    assert (counter.lines, counter.chars) == (1, 13)
+
+
 def test_op_GN1():
     vm = VM("bla")
     assert vm.label_counter == 1
@@ -420,6 +1403,63 @@ def test_op_OUT():
     assert output.getvalue() == "teststrteststr2\n"
 
 
+@pytest.mark.parametrize("flush, written", [
+    ("line", ["a\n", "b\n", "c\n"]),
+    ("end", []),
+    (4, ["a\nb\n"]),
+])
+def test_output_writer(flush, written):
+    class File:
+        def __init__(self):
+            self.writes = []
+
+        def write(self, text):
+            self.writes.append(text)
+
+    file = File()
+    writer = OutputWriter(file, flush=flush)
+    for line in ("a\n", "b\n", "c\n"):
+        writer.write_line(line)
+
+    assert file.writes == written
+    writer.flush()
+    assert "".join(file.writes) == "a\nb\nc\n"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_line_counter(engine):
+    counter = LineCounter()
+    VM(open("metaii.meta").read(), counter).run(parse_code(open("metaii.masm")),
+                                                engine=engine)
+    result = open("metaii.masm").read()
+    assert (counter.lines, counter.chars) == (result.count("\n"), len(result))
+
+
+def test_line_counter_main(capsys):
+    main(["--count", "--no-cache", "metaii.masm", "-i", "metaii.meta"])
+    result = open("metaii.masm").read()
+    assert capsys.readouterr().out == "{} lines, {} characters\n".format(
+        result.count("\n"), len(result))
+
+
+def test_output_writer_binary(tmp_path):
+    output = io.BytesIO()
+    vm = VM("", output, flush="end", encoding="utf-16")
+    vm.run([Inst(op="CL", arg="é", labels=[]),
+            Inst(op="OUT", arg=None, labels=[]),
+            Inst(op="CL", arg="ü", labels=[]),
+            Inst(op="OUT", arg=None, labels=[]),
+            Inst(op="END", arg=None, labels=[])])
+    assert output.getvalue().decode("utf-16") == "        é\n        ü\n"
+
+    path = tmp_path / "out"
+    with open(path, "wb") as f:
+        writer = OutputWriter(f.fileno())
+        writer.write_line("é\n")
+        writer.flush()
+    assert path.read_bytes() == "é\n".encode()
+
+
 def test_op_ADR():
     # TODO: Should be a metaop? Just a starting pc?
     vm = VM("bla")